@@ -31,6 +31,16 @@ import torch.optim as optim
 
 import os
 from os import walk
+import contextlib
+import copy
+import io
+import multiprocessing
+import random
+import struct
+import zipfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 from sklearn import metrics, svm
@@ -47,6 +57,7 @@ from scipy.cluster.hierarchy import dendrogram, linkage
 from scipy.stats import ttest_ind
 
 import json
+import hashlib
 
 import numpy as np
 
@@ -1140,50 +1151,402 @@ meta_groups = [
 meta_groups = pd.DataFrame(meta_groups)
 meta_groups.columns = ['l0', 'l1', 'l2', 'l3']
 
+
+# write the marker file of an on-disk cache (json for .json paths, a numpy array otherwise) -- called after everything else of the cache
+# is written, and readers check the marker first, so an interrupted build is never mistaken for a complete cache
+def write_cache_marker(path, value):
+    with open(path+'.tmp', 'w' if path.endswith('.json') else 'wb') as f:
+        if path.endswith('.json'):
+            json.dump(value, f)
+        else:
+            np.save(f, value)
+    os.replace(path+'.tmp', path)
+
+
+# thread pool of owner (with max_workers threads) -- created lazily in every process, since threads do not survive a fork
+# into loader or extraction workers; owner keeps the pid the pool belongs to
+def process_pool(owner, max_workers):
+    if owner.pid != os.getpid():
+        owner.pid = os.getpid()
+        owner.pool = ThreadPoolExecutor(max_workers=max_workers)
+    return owner.pool
+
+'''
+ZipSource serves data.csv and images straight from data.zip, without unpacking it into PATH.
+The archive is opened once and its member names are indexed to their offsets; members are then read with positioned reads (os.pread),
+which are safe to share between threads and forked loader workers. A thread pool can read ahead the members a dataset is about to request.
+'''
+
+class ZipSource(object):
+
+    def __init__(self, zip_path, threads=4, read_ahead=32):
+
+        self.zip_path = zip_path
+        self.threads = threads
+        self.read_ahead = read_ahead
+
+        with zipfile.ZipFile(zip_path) as archive:
+            members = [m for m in archive.infolist() if not m.is_dir()]
+
+        # names are taken relative to the folder holding data.csv -- the same paths as under PATH once unpacked
+        root = min([m.filename for m in members if m.filename.endswith('data.csv')], key=len)[:-len('data.csv')]
+        self.index = {m.filename[len(root):]: (m.header_offset, m.compress_size, m.compress_type) 
+            for m in members if m.filename.startswith(root)}
+
+        self.fd = os.open(zip_path, os.O_RDONLY)
+        self.pid = None
+
+    # worker processes reopen the archive and reuse the index
+    def __getstate__(self):
+        return {'zip_path': self.zip_path, 'threads': self.threads, 'read_ahead': self.read_ahead, 'index': self.index}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.fd = os.open(self.zip_path, os.O_RDONLY)
+        self.pid = None
+
+    def __contains__(self, name):
+        return name in self.index
+
+    # read-ahead pool of this process (see process_pool), with its own pending reads
+    def _pool(self):
+        if self.pid != os.getpid():
+            self.pending = OrderedDict()
+        return process_pool(self, self.threads)
+
+    # raw bytes of a member: the local file header gives the data offset, then the data is inflated if compressed
+    def _read(self, name):
+
+        offset, size, method = self.index[name]
+        header = os.pread(self.fd, 30, offset)
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        raw = os.pread(self.fd, size, offset + 30 + name_len + extra_len)
+
+        if method == zipfile.ZIP_STORED:
+            return raw
+        if method == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(raw, -15)
+        raise ValueError('Unsupported compression method {} for {} in {}'.format(method, name, self.zip_path))
+
+    def read(self, name):
+        if self.threads > 0:
+            self._pool()
+            future = self.pending.pop(name, None)
+            if future is not None:
+                return future.result()
+        return self._read(name)
+
+    # start reading members in the background; at most read_ahead requests are in flight -- the oldest are cancelled to make room
+    def prefetch(self, names):
+
+        if self.threads == 0:
+            return
+
+        pool = self._pool()
+        for name in names:
+            if name in self.index and name not in self.pending:
+                while len(self.pending) >= self.read_ahead:
+                    self.pending.popitem(last=False)[1].cancel()
+                self.pending[name] = pool.submit(self._read, name)
+
+
+# open an image given its path relative to PATH -- from data.zip if it is used as the data source
+# draft=True lets the JPEG decoder downscale in the DCT domain (by 1/2, 1/4 or 1/8) to the smallest size that still covers 224x224
+def open_image(img_path, draft=False):
+
+    if zip_source is not None:
+        img = Image.open(io.BytesIO(zip_source.read(img_path)))
+    else:
+        img = Image.open(PATH + '/' + img_path)
+
+    if draft:
+        img.draft(img.mode, (224, 224))
+    return img
+
+
+# pixel difference between draft and full-resolution decoding, both followed by Resize(224), for a random sample of images
+# differences are absolute, in 0-255 units, per image
+def draft_decode_difference(data, n=100, cropped=False):
+
+    paths = data['img_path_face_only' if cropped else 'img_path'].values.astype('str')
+    paths = np.random.RandomState(999).choice(paths, min(n, paths.shape[0]), replace=False)
+    resize = transforms.Resize(224)
+
+    max_diff = []
+    mean_diff = []
+    for p in tqdm(paths):
+        full = np.asarray(resize(open_image(p)), dtype=np.float32)
+        reduced = np.asarray(resize(open_image(p, draft=True)), dtype=np.float32)
+        diff = np.abs(full - reduced)
+        max_diff.append(diff.max())
+        mean_diff.append(diff.mean())
+
+    return pd.DataFrame({'img_path': paths, 'max_abs_diff': max_diff, 'mean_abs_diff': mean_diff})
+
+
+
+# size and modification time of the file data.csv is read from -- caches derived from data are valid only under the same stamp
+def data_source_stamp():
+    source = DATA_ZIP if zip_source is not None else PATH+'/data.csv'
+    return [os.path.getsize(source), os.path.getmtime(source)]
+
+
+# read data.csv (from PATH or data.zip) -- optionally through a typed binary cache in cache_dir
+# the first run saves every column as .npy (strings as fixed-width unicode plus a null mask), later runs memory-map them instead of parsing text
+# (string columns become Python objects in the data frame -- image paths are also saved as one fixed-width array, see read_image_paths)
+# the cache is rebuilt when the size or modification time of the source file changes
+def read_data(cache_dir=None):
+
+    stamp = data_source_stamp()
+
+    if cache_dir is not None and os.path.exists(cache_dir+'/columns.json'):
+        with open(cache_dir+'/columns.json', 'r') as fjson:
+            meta = json.load(fjson)
+
+        if meta['source'] == stamp:
+            columns = {}
+            for i, c in enumerate(meta['columns']):
+                col = np.load(cache_dir+'/{}.npy'.format(i), mmap_mode='r')
+                if i in meta['strings']:
+                    col = col.astype(object)
+                    col[np.load(cache_dir+'/{}_null.npy'.format(i))] = np.nan
+                columns[c] = col
+            return pd.DataFrame(columns, columns=meta['columns'])
+
+    if zip_source is not None:
+        data = pd.read_csv(io.BytesIO(zip_source.read('data.csv')))
+    else:
+        data = pd.read_csv(PATH+'/data.csv')
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        strings = []
+        for i, c in enumerate(data.columns):
+            if data[c].dtype == object:
+                strings.append(i)
+                np.save(cache_dir+'/{}.npy'.format(i), data[c].fillna('').values.astype('U'))
+                np.save(cache_dir+'/{}_null.npy'.format(i), data[c].isnull().values)
+            else:
+                np.save(cache_dir+'/{}.npy'.format(i), data[c].values)
+        np.save(cache_dir+'/image_paths.npy', data[['img_path', 'img_path_face_only']].values.astype('U'))
+
+        write_cache_marker(cache_dir+'/columns.json', {'source': stamp, 'columns': data.columns.tolist(), 'strings': strings})
+
+    return data
+
+
+# compact matrices of labels (int8, rows of data x q_list) and image metrics (float32, rows of data x im_list)
+# built once -- and memory-mapped from cache_dir on later runs -- so that datasets index into them instead of copying columns of data
+# the cache is rebuilt when the variables or the source of data (data_source_stamp) change
+def get_data_matrices(data, cache_dir=None):
+
+    stamp = data_source_stamp()
+
+    if cache_dir is not None and os.path.exists(cache_dir+'/matrices.json'):
+        with open(cache_dir+'/matrices.json', 'r') as fjson:
+            meta = json.load(fjson)
+        if meta == {'source': stamp, 'rows': data.shape[0], 'q_list': q_list, 'im_list': im_list}:
+            return np.load(cache_dir+'/labels.npy', mmap_mode='r'), np.load(cache_dir+'/image_metrics.npy', mmap_mode='r')
+
+    labels = data[q_list].values.astype('int8')
+    if not (labels == data[q_list].values).all():
+        raise ValueError('Labels in q_list do not fit into int8')
+    immetr = data[im_list].values.astype('float32')
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_dir+'/labels.npy', labels)
+        np.save(cache_dir+'/image_metrics.npy', immetr)
+        write_cache_marker(cache_dir+'/matrices.json', {'source': stamp, 'rows': data.shape[0], 'q_list': q_list, 'im_list': im_list})
+
+    return labels, immetr
+
+
+# image paths (full and cropped) per row of data as a fixed-width unicode array -- memory-mapped from the read_data cache in cache_dir
+def read_image_paths(data, cache_dir=None):
+    if cache_dir is not None and os.path.exists(cache_dir+'/image_paths.npy'):
+        return np.load(cache_dir+'/image_paths.npy', mmap_mode='r')
+    return data[['img_path', 'img_path_face_only']].values.astype('str')
+
+
+
+'''
+ImageCache holds every image decoded once and resized to 224 (same as in CustomDataset) in a memory-mapped uint8 array (N x 3 x 224 x 224).
+Rows are looked up by image path -- both img_path and img_path_face_only are stored -- so repeated deterministic passes skip file I/O and JPEG decoding.
+'''
+
+class ImageCache(object):
+
+    def __init__(self, cache_dir):
+
+        self.cache_dir = cache_dir
+        # copy-on-write mapping: writable for torch.from_numpy, but the file itself is never modified
+        self.images = np.load(cache_dir+'/images.npy', mmap_mode='c')
+        with open(cache_dir+'/index.json', 'r') as fjson:
+            self.index = json.load(fjson)
+
+    def __contains__(self, img_path):
+        return img_path in self.index
+
+    def __getitem__(self, img_path):
+        # uint8 tensor [3, 224, 224] viewing the memory map -- no copy
+        return torch.from_numpy(self.images[self.index[img_path]])
+
+    def __len__(self):
+        return len(self.index)
+
+    # worker processes reopen the memory map instead of receiving a pickled copy of the array
+    def __getstate__(self):
+        return {'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'])
+
+
+# stamp of the images at paths and of how they are decoded: size and modification time of data.zip (ZIP_DATA) or of every image file,
+# the resize and JPEG draft decoding -- a cache built under another stamp holds stale images
+def image_source_stamp(paths):
+    if zip_source is not None:
+        files = [os.path.getsize(DATA_ZIP), os.path.getmtime(DATA_ZIP)]
+    else:
+        h = hashlib.sha1()
+        for p in paths:
+            st = os.stat(PATH + '/' + p)
+            h.update('{}\t{}\t{}\n'.format(p, st.st_size, st.st_mtime).encode())
+        files = h.hexdigest()
+    return {'files': files, 'resize': 224, 'draft': JPEG_DRAFT}
+
+
+# decode and resize every image referenced in data once and store the result in a memory-mapped cache
+def build_image_cache(data, cache_dir):
+
+    paths = sorted(set(data['img_path'].values.astype('str')) | set(data['img_path_face_only'].values.astype('str')))
+    stamp = image_source_stamp(paths)
+    resize = transforms.Resize(224)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    images = np.lib.format.open_memmap(cache_dir+'/images.npy', mode='w+', dtype=np.uint8, shape=(len(paths), 3, 224, 224))
+
+    for i, p in enumerate(tqdm(paths)):
+        if zip_source is not None:
+            zip_source.prefetch(paths[i+1:i+1+zip_source.read_ahead])
+        img = resize(open_image(p, draft=JPEG_DRAFT))
+        images[i] = np.asarray(img, dtype=np.uint8).transpose(2, 0, 1)
+
+    images.flush()
+    del images
+
+    with open(cache_dir+'/source.json', 'w') as fjson:
+        json.dump(stamp, fjson)
+
+    write_cache_marker(cache_dir+'/index.json', {p: i for i, p in enumerate(paths)})
+
+    return ImageCache(cache_dir)
+
+
+# load the image cache from disk, (re)building it if it is missing, does not cover all images in data or was built from other images
+def get_image_cache(data, cache_dir):
+
+    if os.path.exists(cache_dir+'/index.json') and os.path.exists(cache_dir+'/source.json'):
+        cache = ImageCache(cache_dir)
+        paths = sorted(set(data['img_path'].values.astype('str')) | set(data['img_path_face_only'].values.astype('str')))
+        with open(cache_dir+'/source.json', 'r') as fjson:
+            stamp = json.load(fjson)
+        if all(p in cache for p in paths) and stamp == image_source_stamp(paths):
+            return cache
+
+    return build_image_cache(data, cache_dir)
+
+
+
 '''
 CustomDataset object takes care of supplying an observation (image, labels).
 It also performs image preprocessing, such as normalization by color channel. 
 In case of training, it also performs random transformations, such as horizontal flips, resized crops, rotations, and color jitter -- to expand the observation pool.
+Observations are given as row positions into the full data set (or as a subset of data, whose index gives the row positions):
+image paths, labels and image metrics are then rows of the global image_paths, label_matrix and metric_matrix.
+Deterministic datasets (tr=False) can read pre-decoded images from an ImageCache instead of the image files.
+With batch_augment=True, training datasets only resize images and yield them as uint8 tensors -- random transformations are then applied to whole batches by augment_batch.
+With uint8=True, images are yielded as uint8 tensors as well, and scaling and normalization are left to normalize_batch on the whole batch.
+When read from data.zip, images of a sequential loader are read ahead up to the end of the batch being loaded (read_ahead_block, set by the loader),
+so that no reads are wasted on shuffled orders or on the batches of other loader workers (read_ahead_streams datasets read at the same time share the read-ahead).
 '''
 
 class CustomDataset(Dataset):
 
-    def __init__(self, data, tr = True, cropped=False):
+    def __init__(self, data, tr = True, cropped=False, cache=None, batch_augment=False, uint8=False):
 
-        self.data = data
-        if not cropped:
-            self.paths = self.data['img_path'].values.astype('str')
+        # row positions into the shared path, label and image metric matrices
+        if isinstance(data, pd.DataFrame):
+            self.rows = data.index.values
         else:
-            self.paths = self.data['img_path_face_only'].values.astype('str')
-        self.data_len = self.data.shape[0]
+            self.rows = np.asarray(data)
 
-        self.labels = self.data[q_list].values.astype('int32')
-        self.image_metrics = self.data[im_list].values.astype('float32')
+        self.cropped = cropped
+        self.paths = image_paths[self.rows, int(cropped)]
+        self.data_len = self.rows.shape[0]
+        self.read_ahead_block = None
+        self.read_ahead_streams = 1
+
+        # per-image random transformations need the original image, so the cache only serves datasets without them
+        self.batch_augment = tr and batch_augment
+        self.uint8 = uint8 or self.batch_augment
+        self.cache = cache if (not tr or self.batch_augment) else None
+
+        self.labels = label_matrix
+        self.image_metrics = metric_matrix
 
         # transforms
-        if tr:
+        if self.uint8:
+            to_tensor = [transforms.PILToTensor()]
+        else:
+            to_tensor = [
+                transforms.ToTensor(),
+                transforms.Normalize([0.485, 0.456, 0.406],[0.229, 0.224, 0.225])]
+
+        if self.batch_augment or (self.uint8 and not tr):
+            self.transforms = transforms.Compose([
+                transforms.Resize(224)] + to_tensor)
+        elif tr:
             self.transforms = transforms.Compose([
                 transforms.Resize(224),
                 transforms.RandomHorizontalFlip(p=0.5),
                 transforms.RandomApply([
                     transforms.RandomResizedCrop(224),
                     transforms.RandomRotation(20),
-                    transforms.ColorJitter(brightness=0.1,contrast=0.1,saturation=0.1,hue=0.1)], p=0.75),
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406],[0.229, 0.224, 0.225])])
+                    transforms.ColorJitter(brightness=0.1,contrast=0.1,saturation=0.1,hue=0.1)], p=0.75)] + to_tensor)
         else:
             self.transforms = transforms.Compose([
                 transforms.Resize(224),
                 transforms.ToTensor(), 
                 transforms.Normalize([0.485, 0.456, 0.406],[0.229, 0.224, 0.225])])
 
+        # cached images are already resized uint8 tensors -- same values as ToTensor() + Normalize() on the decoded image
+        self.cache_transforms = transforms.Compose([
+            transforms.ConvertImageDtype(torch.float),
+            transforms.Normalize([0.485, 0.456, 0.406],[0.229, 0.224, 0.225])])
+
     def __getitem__(self, index):
-        
-        img_path = PATH + '/'+ self.paths[index]
-        img = Image.open(img_path)
-        img_tensor = self.transforms(img)
-        label = self.labels[index]
-        image_metric = self.image_metrics[index]
+
+        # SeededRandomSampler supplies (index, seed) -- random transformations are then drawn from the sample's own seed
+        if isinstance(index, tuple):
+            index, seed = index
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(seed)
+                return self.__getitem__(index)
+
+        if self.cache is not None:
+            img_tensor = self.cache[self.paths[index]]
+            if not self.uint8:
+                img_tensor = self.cache_transforms(img_tensor)
+        else:
+            if zip_source is not None and self.read_ahead_block is not None:
+                block_end = (index // self.read_ahead_block + 1) * self.read_ahead_block
+                zip_source.prefetch(self.paths[index+1:min(index+1+zip_source.read_ahead // self.read_ahead_streams, block_end)])
+            img = open_image(self.paths[index], draft=JPEG_DRAFT)
+            img_tensor = self.transforms(img)
+        label = self.labels[self.rows[index]].astype('int32')
+        image_metric = self.image_metrics[self.rows[index]].astype('float32')
 
         return (img_tensor, label, image_metric)
 
@@ -1192,18 +1555,406 @@ class CustomDataset(Dataset):
 
 
 
+'''
+JointDataset supplies the full and the cropped (face only) image of an observation together, with its labels and image metrics once.
+Both images go through the deterministic transforms of CustomDataset (tr=False), so they match the images of two separate datasets.
+'''
+
+class JointDataset(Dataset):
+
+    def __init__(self, data, cache=None, uint8=False):
+        self.full_dataset = CustomDataset(data, tr=False, cropped=False, cache=cache, uint8=uint8)
+        self.cropped_dataset = CustomDataset(data, tr=False, cropped=True, cache=cache, uint8=uint8)
+        self.rows = self.full_dataset.rows
+
+    def __getitem__(self, index):
+        img, labels, image_metrics = self.full_dataset[index]
+        img_cropped, _, _ = self.cropped_dataset[index]
+        return (img, img_cropped, labels, image_metrics)
+
+    def __len__(self):
+        return len(self.full_dataset)
+
+
+
+# scale a batch of images to [0, 1] (if uint8) and normalize by color channel -- same as ToTensor() + Normalize() in CustomDataset
+def normalize_batch(images):
+
+    if images.dtype == torch.uint8:
+        images = images.float().div(255)
+
+    mean = torch.tensor([0.485, 0.456, 0.406], device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225], device=images.device).view(1, 3, 1, 1)
+    return (images - mean) / std
+
+
+# shift the hue of every image in a [0, 1] batch [n, 3, h, w] by its own amount (fraction of the hue circle) via HSV
+def shift_hue(images, shift):
+
+    r, g, b = images.unbind(1)
+    maxc, _ = images.max(1)
+    minc, _ = images.min(1)
+    delta = maxc - minc
+
+    v = maxc
+    s = delta / torch.where(maxc > 0, maxc, torch.ones_like(maxc))
+    delta_safe = torch.where(delta > 0, delta, torch.ones_like(delta))
+    rc, gc, bc = (maxc - r) / delta_safe, (maxc - g) / delta_safe, (maxc - b) / delta_safe
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = (h / 6.0 + shift.view(-1, 1, 1)) % 1.0
+
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+    p, q, t = v * (1.0 - s), v * (1.0 - s * f), v * (1.0 - s * (1.0 - f))
+
+    # candidate values of each channel for the six hue sectors, picked by sector index i
+    sectors = torch.stack([torch.stack([v, q, p, p, t, v], 1),
+                           torch.stack([t, v, v, q, p, p], 1),
+                           torch.stack([p, p, t, v, v, q], 1)], 1) # [n, 3, 6, h, w]
+    index = i.unsqueeze(1).unsqueeze(1).expand(-1, 3, 1, -1, -1)
+    return sectors.gather(2, index).squeeze(2)
+
+
+# batched counterpart of the random transformations in CustomDataset, applied to a collated uint8 batch [n, 3, 224, 224]
+# every sample draws its own flip, crop, rotation and color jitter parameters; resized crop and rotation are fused into one affine resampling
+# returns the augmented batch normalized by color channel
+def augment_batch(images, p_flip=0.5, p_apply=0.75, scale=(0.08, 1.0), ratio=(3./4., 4./3.), degrees=20, jitter=0.1):
+
+    n, _, h, w = images.shape
+    device = images.device
+    x = images.float().div(255)
+
+    # RandomHorizontalFlip(p=0.5)
+    flip = torch.rand(n, device=device) < p_flip
+    x = torch.where(flip.view(-1, 1, 1, 1), x.flip(-1), x)
+
+    # RandomApply([...], p=0.75)
+    apply = torch.rand(n, device=device) < p_apply
+
+    # RandomResizedCrop(224): crop area and log-uniform aspect ratio per sample -- crops are clamped to the image instead of resampled
+    area = torch.empty(n, device=device).uniform_(*scale) * h * w
+    aspect = torch.exp(torch.empty(n, device=device).uniform_(np.log(ratio[0]), np.log(ratio[1])))
+    crop_w = (torch.sqrt(area * aspect) / w).clamp(max=1.0)
+    crop_h = (torch.sqrt(area / aspect) / h).clamp(max=1.0)
+    crop_x = (torch.rand(n, device=device) * 2.0 - 1.0) * (1.0 - crop_w)
+    crop_y = (torch.rand(n, device=device) * 2.0 - 1.0) * (1.0 - crop_h)
+
+    # RandomRotation(20) of the cropped image around its center
+    angle = torch.empty(n, device=device).uniform_(-degrees, degrees) * np.pi / 180.0
+    cos, sin = torch.cos(angle), torch.sin(angle)
+
+    # output grid -> rotated crop -> input image, in normalized coordinates
+    theta = torch.stack([torch.stack([crop_w * cos, -crop_w * sin, crop_x], 1),
+                         torch.stack([crop_h * sin, crop_h * cos, crop_y], 1)], 1) # [n, 2, 3]
+    grid = F.affine_grid(theta, (n, 3, h, w), align_corners=False)
+    x_aug = F.grid_sample(x, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+    # ColorJitter(brightness=0.1,contrast=0.1,saturation=0.1,hue=0.1) -- per-sample factors, adjustments in a random order per batch
+    factors = torch.empty(3, n, device=device).uniform_(1.0 - jitter, 1.0 + jitter).view(3, n, 1, 1, 1)
+    hue = torch.empty(n, device=device).uniform_(-jitter, jitter)
+    gray_weights = torch.tensor([0.299, 0.587, 0.114], device=device).view(1, 3, 1, 1)
+
+    for op in torch.randperm(4).tolist():
+        if op == 0: # brightness
+            x_aug = (x_aug * factors[0]).clamp(0.0, 1.0)
+        elif op == 1: # contrast
+            mean = (x_aug * gray_weights).sum(1, keepdim=True).mean((2, 3), keepdim=True)
+            x_aug = (factors[1] * x_aug + (1.0 - factors[1]) * mean).clamp(0.0, 1.0)
+        elif op == 2: # saturation
+            gray = (x_aug * gray_weights).sum(1, keepdim=True)
+            x_aug = (factors[2] * x_aug + (1.0 - factors[2]) * gray).clamp(0.0, 1.0)
+        else: # hue
+            x_aug = shift_hue(x_aug, hue)
+
+    x = torch.where(apply.view(-1, 1, 1, 1), x_aug, x)
+
+    return normalize_batch(x)
+
+
+
+# (kernel, stride, padding) of a module along a spatial axis -- output o depends on inputs o*stride-padding ... o*stride-padding+kernel-1
+# convolutions and pools from their attributes, pointwise modules (1, 1, 0), Sequential composed, ResNet blocks (conv1, ..., downsample)
+# as the union of the main path and the shortcut; None for modules whose outputs may depend on all inputs (adaptive pooling, ...)
+def receptive_field(module):
+
+    if isinstance(module, (torch.nn.Conv2d, torch.nn.MaxPool2d, torch.nn.AvgPool2d)):
+        k, s, p = [v if isinstance(v, int) else v[0] for v in (module.kernel_size, module.stride, module.padding)]
+        d = getattr(module, 'dilation', 1)
+        d = d if isinstance(d, int) else d[0]
+        return (d*(k-1)+1, s, p)
+
+    if isinstance(module, (torch.nn.BatchNorm2d, torch.nn.ReLU, torch.nn.Identity)):
+        return (1, 1, 0)
+
+    if isinstance(module, torch.nn.Sequential):
+        rf = (1, 1, 0)
+        for child in module:
+            child_rf = receptive_field(child)
+            if child_rf is None:
+                return None
+            rf = compose_receptive_fields(rf, child_rf)
+        return rf
+
+    if hasattr(module, 'conv1') and hasattr(module, 'downsample'):
+        main = (1, 1, 0)
+        for child in module.children():
+            if isinstance(child, torch.nn.Conv2d):
+                main = compose_receptive_fields(main, receptive_field(child))
+        shortcut = (1, 1, 0) if module.downsample is None else receptive_field(module.downsample)
+        if shortcut is None or shortcut[1] != main[1]:
+            return None
+        start = min(-main[2], -shortcut[2])
+        end = max(-main[2] + main[0] - 1, -shortcut[2] + shortcut[0] - 1)
+        return (end - start + 1, main[1], -start)
+
+    return None
+
+
+# receptive field of module `outer` applied to the output of module `inner`
+def compose_receptive_fields(inner, outer):
+    (k1, s1, p1), (k2, s2, p2) = inner, outer
+    return ((k2-1)*s1 + k1, s1*s2, p2*s1 + p1)
+
+
+# outputs [o0, o1) of a module with receptive field (k, s, p) and n_out outputs along an axis changed by a change of inputs [b0, b1),
+# and the input crop [i0, i1) they depend on -- it covers [b0, b1) and starts at a multiple of s, so that the module run on the crop
+# gives output o at position o - i0/s
+def occlusion_span(b0, b1, k, s, p, n_in, n_out):
+    o0 = max(-((k - 1 - p - b0) // s), 0)
+    o1 = min((b1 - 1 + p) // s + 1, n_out)
+    i0 = (min(max(o0*s - p, 0), b0) // s) * s
+    i1 = min(max((o1 - 1)*s - p + k, b1), n_in)
+    return o0, o1, i0, i1
+
+
+# outputs of a branch (conv net of modules and Sequential stages) for images x with each of the windows blacked out, as a (windows x images x ...) tensor
+# activations of x are computed once; for every window, each module is rerun only on the crop of its input the changed region reaches,
+# and the changed region of its output is carried on to the next module -- modules without a receptive_field are rerun on the whole input
+def occluded_outputs(branch, x, windows):
+
+    units = []
+    for child in branch.children():
+        units += list(child.children()) if isinstance(child, torch.nn.Sequential) else [child]
+
+    activations = [x]
+    for unit in units:
+        activations.append(unit(activations[-1]))
+
+    out = []
+    for (y0, y1, x0, x1) in windows:
+
+        # changed region of the input of the current unit, and its values -- blackout sets normalized values to 0
+        r0, r1, c0, c1 = y0, y1, x0, x1
+        region = torch.zeros_like(x[:, :, y0:y1, x0:x1])
+
+        for i, unit in enumerate(units):
+            a = activations[i]
+            rf = receptive_field(unit)
+
+            if rf is None:
+                a = a.clone()
+                a[:, :, r0:r1, c0:c1] = region
+                region = unit(a)
+                r0, r1, c0, c1 = 0, region.shape[2], 0, region.shape[3]
+                continue
+
+            k, s, p = rf
+            o0, o1, i0, i1 = occlusion_span(r0, r1, k, s, p, a.shape[2], activations[i+1].shape[2])
+            q0, q1, j0, j1 = occlusion_span(c0, c1, k, s, p, a.shape[3], activations[i+1].shape[3])
+
+            crop = a[:, :, i0:i1, j0:j1].clone()
+            crop[:, :, r0-i0:r1-i0, c0-j0:c1-j0] = region
+            region = unit(crop)[:, :, o0-i0//s:o1-i0//s, q0-j0//s:q1-j0//s]
+            r0, r1, c0, c1 = o0, o1, q0, q1
+
+        a = activations[-1].clone()
+        a[:, :, r0:r1, c0:c1] = region
+        out.append(a)
+
+    return torch.stack(out)
+
+
+
+# sha1 over a module's state_dict -- quantized tensors by their integer values, scales and zero points,
+# so two calibrations of the same weights get different hashes
+def state_dict_hash(module):
+    h = hashlib.sha1()
+
+    def update(value):
+        if isinstance(value, (tuple, list)):
+            for v in value:
+                update(v)
+        elif isinstance(value, torch.Tensor) and value.is_quantized:
+            h.update(value.int_repr().cpu().numpy().tobytes())
+            if value.qscheme() in (torch.per_tensor_affine, torch.per_tensor_symmetric):
+                h.update(repr((value.q_scale(), value.q_zero_point())).encode())
+            else:
+                h.update(value.q_per_channel_scales().cpu().numpy().tobytes())
+                h.update(value.q_per_channel_zero_points().cpu().numpy().tobytes())
+                h.update(repr(value.q_per_channel_axis()).encode())
+        elif isinstance(value, torch.Tensor):
+            h.update(value.detach().cpu().numpy().tobytes())
+        else:
+            h.update(repr(value).encode())
+
+    for name, value in module.state_dict().items():
+        h.update(name.encode())
+        update(value)
+    return h.hexdigest()
+
+
+
 class Ensemble(torch.nn.Module):
     def __init__(self, modelA, modelB):
         super(Ensemble, self).__init__()
         self.modelA = modelA
         self.modelB = modelB
+        self.hashes = {}
+        self.precision = 'fp32'
+        self.pid = None
+        self.pool = None
         
     def forward(self, x):
-        x1 = self.modelA(x)
-        x2 = self.modelB(x)
+        x1, x2 = self.branches(x)
+        out = torch.cat((x1, x2), dim=1)
+        return out
+
+    # float32 output of one branch ('modelA' or 'modelB') -- grad mode and autocast are per thread, so they are set here
+    def branch(self, part, x, grad_enabled=True):
+        with torch.set_grad_enabled(grad_enabled), self.precision_context():
+            return getattr(self, part)(x).float()
+
+    # outputs of both branches -- with CONCURRENT_BRANCHES, modelB runs on a second thread while modelA runs on this one
+    # (not while tracing, as the tracer only records ops of its own thread)
+    def branches(self, x):
+        grad_enabled = torch.is_grad_enabled()
+        if not CONCURRENT_BRANCHES or torch.jit.is_tracing():
+            return self.branch('modelA', x, grad_enabled), self.branch('modelB', x, grad_enabled)
+
+        future = self._pool().submit(self.branch, 'modelB', x, grad_enabled)
+        x1 = self.branch('modelA', x, grad_enabled)
+        return x1, future.result()
+
+    # branch thread of this process, see process_pool
+    def _pool(self):
+        return process_pool(self, 1)
+
+    # bfloat16 autocast on CPU for an ensemble in 'bf16' precision, no-op otherwise
+    def precision_context(self):
+        if self.precision == 'bf16':
+            return torch.cpu.amp.autocast(dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    # sha1 of the weights of the ensemble (part=None) or of one of its parts ('modelA', 'modelB'), computed once
+    def weights_hash(self, part=None):
+        if part not in self.hashes:
+            module = self if part is None else getattr(self, part)
+            self.hashes[part] = state_dict_hash(module)
+        return self.hashes[part]
+
+    # same output as forward for images at the given paths, with features read from / written to a FeatureStore:
+    # the whole output under the weights of the ensemble (full=True), the modelB output under the weights of modelB (branch=True)
+    def forward_cached(self, x, store, paths, cropped, blackout=None, full=True, branch=True):
+
+        if full:
+            out = store.lookup(self.weights_hash(), paths, cropped, blackout)
+            if out is not None:
+                return torch.from_numpy(out).to(x.device).view(x.shape[0], -1, 1, 1)
+
+        x2 = store.lookup(self.weights_hash('modelB'), paths, cropped, blackout) if branch else None
+        if x2 is None:
+            x1, x2 = self.branches(x)
+            if branch:
+                store.store(self.weights_hash('modelB'), paths, cropped, blackout, x2.detach().cpu().numpy().reshape(x2.shape[0], -1))
+        else:
+            x1 = self.branch('modelA', x, torch.is_grad_enabled())
+            x2 = torch.from_numpy(x2).to(x1.device).view(x1.shape[0], -1, 1, 1)
         out = torch.cat((x1, x2), dim=1)
+
+        if full:
+            store.store(self.weights_hash(), paths, cropped, blackout, out.detach().cpu().numpy().reshape(out.shape[0], -1))
         return out
 
+    # same output as forward for images x with each of the windows blacked out, as a (windows x images x ...) tensor -- see occluded_outputs
+    # with parts (e.g. ('modelA',)), a list of the outputs of those branches only
+    def forward_occluded(self, x, windows, parts=None):
+        with self.precision_context():
+            out = [occluded_outputs(getattr(self, part), x, windows).float() for part in (parts or ('modelA', 'modelB'))]
+        if parts is not None:
+            return out
+        return torch.cat(out, dim=2)
+
+
+
+'''
+FeatureStore is an on-disk store of image features, addressed by content: (weights hash, image path, cropped flag, blackout rectangle).
+Features of one model and image transform live in a table -- a memory-mapped float32 array with a row per image of data and a mask of rows computed --
+whose file name is a hash of the weights, the transform (including JPEG draft decoding) and the list of image paths.
+Re-running the script (or resuming it after a crash) then skips every forward pass whose inputs did not change.
+It also serves the VGGFace2 half of the Ensemble, which is never finetuned and so is the same in every fold.
+'''
+
+class FeatureStore(object):
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.tables = {}
+        self.indexes = {}
+        self.pid = os.getpid()
+
+    # image path -> table row, for all full (cropped=False) or cropped images in data
+    def _index(self, cropped):
+        if cropped not in self.indexes:
+            paths = image_paths[:, int(cropped)].tolist()
+            self.indexes[cropped] = (hashlib.sha1('\n'.join(paths).encode()).hexdigest(), {p: i for i, p in enumerate(paths)})
+        return self.indexes[cropped]
+
+    # features, done mask and path index of a table -- created (when dim is given) if it does not exist yet
+    # only the process that made the store creates tables: forked extraction workers write to tables opened before the fork
+    def _table(self, weights_hash, cropped, blackout, dim=None):
+
+        blackout = None if blackout is None else tuple(int(b) for b in blackout)
+        key = (weights_hash, bool(cropped), JPEG_DRAFT, blackout)
+
+        if key not in self.tables:
+            paths_hash, index = self._index(bool(cropped))
+            path = self.store_dir+'/'+hashlib.sha1(repr(key + (paths_hash,)).encode()).hexdigest()
+
+            if not os.path.exists(path+'_done.npy'):
+                if dim is None or os.getpid() != self.pid:
+                    return None
+                os.makedirs(self.store_dir, exist_ok=True)
+                features = np.lib.format.open_memmap(path+'_features.npy', mode='w+', dtype=np.float32, shape=(len(index), dim))
+                del features
+                write_cache_marker(path+'_done.npy', np.zeros(len(index), dtype=bool))
+
+            self.tables[key] = (np.load(path+'_features.npy', mmap_mode='r+'), np.load(path+'_done.npy', mmap_mode='r+'), index)
+
+        return self.tables[key]
+
+    # features of the images at the given paths, or None if any of them has not been computed yet
+    def lookup(self, weights_hash, paths, cropped, blackout=None):
+        table = self._table(weights_hash, cropped, blackout)
+        if table is None:
+            return None
+        features, done, index = table
+        rows = [index[p] for p in paths]
+        if not done[rows].all():
+            return None
+        return np.array(features[rows])
+
+    def store(self, weights_hash, paths, cropped, blackout, values):
+        table = self._table(weights_hash, cropped, blackout, dim=values.shape[1])
+        if table is None:
+            return
+        features, done, index = table
+        rows = [index[p] for p in paths]
+        features[rows] = values
+        features.flush()
+        done[rows] = True
+        done.flush()
+
 
 
 # https://github.com/cydonia999/VGGFace2-pytorch/blob/master/demo.py
@@ -1251,18 +2002,264 @@ def get_pretrained(finetuned=False):
     return model
 
 
+# static int8 post-training quantization of one branch of the Ensemble (FX graph mode, fbgemm backend),
+# with activation ranges calibrated on the first n_batches of loader
+def quantize_branch(branch, loader, n_batches=10):
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import prepare_fx, convert_fx
+
+    prepared = prepare_fx(copy.deepcopy(branch).eval(), {'': get_default_qconfig('fbgemm')})
+    with torch.no_grad():
+        for batch_i, (data, _, _) in enumerate(loader):
+            if batch_i == n_batches:
+                break
+            if data.dtype == torch.uint8:
+                data = normalize_batch(data)
+            prepared(data)
+    return convert_fx(prepared)
+
+
+# copy of an fp32 Ensemble for CPU inference in lower precision:
+# 'int8' -- both branches quantized by quantize_branch, calibrated on loader; 'bf16' -- the same weights run under bfloat16 autocast
+# weights hashes carry the precision, so a FeatureStore keeps low-precision features apart from fp32 ones
+def low_precision_ensemble(model, precision, loader=None):
+    if CUDA:
+        raise ValueError('low-precision inference is for CPU-only runs')
+    if precision not in ('int8', 'bf16'):
+        raise ValueError('unknown precision: {}'.format(precision))
+
+    if precision == 'int8':
+        model_lp = Ensemble(quantize_branch(model.modelA, loader), quantize_branch(model.modelB, loader))
+    else:
+        model_lp = Ensemble(model.modelA, model.modelB)
+    model_lp.precision = precision
+    model_lp.eval()
+
+    # bf16 keeps the fp32 weights, so its hashes are the fp32 ones tagged with the precision; int8 hashes are computed
+    # from the quantized modules -- each calibration gets its own scales and zero points, and its own store entries
+    if precision == 'bf16':
+        for part in [None, 'modelA', 'modelB']:
+            model_lp.hashes[part] = model.weights_hash(part) + '-' + precision
+    return model_lp
+
+
+
+'''
+ModelRegistry keeps one Ensemble resident for the whole process: both ResNets are built and the VGGFace2 weights unpickled once,
+and every finetuned ImageNet net is handed over in memory by copying its state_dict into the preallocated ImageNet branch.
+Only the hashes of that branch and of the whole ensemble are reset on a swap -- the VGGFace2 hash stays valid for the FeatureStore.
+'''
+
+class ModelRegistry(object):
+
+    def __init__(self):
+        self.model = None
+
+    # the resident Ensemble, with the ImageNet branch set to state_dict (if given)
+    def get(self, state_dict=None):
+        if self.model is None:
+            self.model = get_pretrained(finetuned=False)
+
+        if state_dict is not None:
+            self.model.modelA.load_state_dict(state_dict)
+            self.model.hashes = {part: h for part, h in self.model.hashes.items() if part == 'modelB'}
+        return self.model
+
+
+'''
+FrozenEnsemble wraps an Ensemble exported by export_frozen_ensemble -- traced to TorchScript and frozen (weights inlined as constants,
+batch norm folded into the convolutions), saved in a single file together with the weights hashes of the source model.
+load_frozen_ensemble restores it in one read, without building the ResNets or unpickling any weights.
+Folding batch norm changes outputs at float precision, so its hashes are tagged -- a FeatureStore keeps its outputs apart from the Ensemble ones
+(whole outputs only, as both branches are folded into one graph).
+'''
+
+class FrozenEnsemble(torch.nn.Module):
+
+    def __init__(self, module, hashes):
+        super(FrozenEnsemble, self).__init__()
+        self.module = module
+        self.hashes = hashes
+
+    def forward(self, x):
+        return self.module(x)
+
+    def weights_hash(self, part=None):
+        return self.hashes[str(part)]
+
+    def forward_cached(self, x, store, paths, cropped, blackout=None, full=True, branch=True):
+        if not full:
+            return self.module(x)
+
+        out = store.lookup(self.weights_hash(), paths, cropped, blackout)
+        if out is not None:
+            return torch.from_numpy(out).to(x.device).view(x.shape[0], -1, 1, 1)
+
+        out = self.module(x)
+        store.store(self.weights_hash(), paths, cropped, blackout, out.detach().cpu().numpy().reshape(out.shape[0], -1))
+        return out
+
+
+# trace and freeze an fp32 Ensemble, and save it to path with its weights hashes and the stamp of the weights it was built from
+def export_frozen_ensemble(model, path, stamp=None):
+    if getattr(model, 'precision', 'fp32') != 'fp32':
+        raise ValueError('only fp32 ensembles can be frozen')
+
+    model.eval()
+    example = torch.zeros(1, 3, 224, 224, device=next(model.parameters()).device)
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(model, example))
+
+    meta = {'hashes': {str(part): model.weights_hash(part) + '-frozen' for part in [None, 'modelA', 'modelB']}, 'source': stamp}
+    torch.jit.save(frozen, path, _extra_files={'meta.json': json.dumps(meta)})
+
+
+# FrozenEnsemble saved at path, or None if there is none or it was built from other weights than stamp
+def load_frozen_ensemble(path, stamp=None):
+    if not os.path.exists(path):
+        return None
+
+    extra = {'meta.json': ''}
+    module = torch.jit.load(path, map_location=torch.device('cuda' if CUDA else 'cpu'), _extra_files=extra)
+    meta = json.loads(extra['meta.json'])
+    if meta['source'] != stamp:
+        return None
+    return FrozenEnsemble(module, meta['hashes'])
+
+
+# final finetuned Ensemble -- with FROZEN_MODEL restored from its frozen artifact in RESULTS, exported there on the first run
+def get_final_model():
+    finetuned_stamp = [os.path.getsize(RESULTS+"/finetuned_imgnet_model"), os.path.getmtime(RESULTS+"/finetuned_imgnet_model")]
+    model = load_frozen_ensemble(RESULTS+'/ensemble_frozen.pt', finetuned_stamp) if FROZEN_MODEL else None
+    if model is None:
+        model = get_pretrained(finetuned=True)
+        if FROZEN_MODEL:
+            export_frozen_ensemble(model, RESULTS+'/ensemble_frozen.pt', finetuned_stamp)
+    return model
+
+
+
+
+'''
+RespondentIndex maps every respondent (randomID) to the rows of data holding their observations, in CSR form:
+rows[indptr[k]:indptr[k+1]] are the row positions of the k-th respondent in the sorted ids.
+Splitting data by respondents is then a gather of integer row positions, with no scan over or copy of the data frame.
+'''
+
+class RespondentIndex(object):
+
+    def __init__(self, respondent_ids):
+        self.ids, codes = np.unique(respondent_ids, return_inverse=True)
+        self.rows = np.argsort(codes, kind='stable')
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=self.ids.shape[0]))])
+
+    # row positions of all observations of the given respondents
+    # rank (position of every row in a shuffled order of data) orders the result as the rows would appear in the shuffled data
+    def gather(self, ids, rank=None):
+
+        k = np.searchsorted(self.ids, ids)
+        starts = self.indptr[k]
+        counts = self.indptr[k+1] - starts
+
+        # consecutive runs rows[starts[j] : starts[j]+counts[j]], concatenated without a Python loop
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        rows = self.rows[offsets]
+
+        if rank is not None:
+            rows = rows[np.argsort(rank[rows], kind='stable')]
+        return rows
+
+
+
+'''
+SeededRandomSampler shuffles observations like shuffle=True, but also draws a seed for every sample and yields (index, seed) pairs.
+CustomDataset applies its random transformations under that seed, so augmentation does not depend on which worker process loads the sample --
+the stream of augmented batches is bit-identical for any number of loader workers.
+'''
+
+class SeededRandomSampler(torch.utils.data.sampler.Sampler):
+
+    def __init__(self, data_source, generator):
+        self.data_source = data_source
+        self.generator = generator
+
+    def __iter__(self):
+        n = len(self.data_source)
+        order = torch.randperm(n, generator=self.generator).tolist()
+        seeds = torch.randint(0, 2**62, (n,), dtype=torch.int64, generator=self.generator).tolist()
+        return iter(zip(order, seeds))
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+# seeds numpy and random in every loader worker from the worker's torch seed, which the DataLoader derives from its generator
+def seed_worker(worker_id):
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
 
 
 # create an object that uses CustomDataset object from above to load multiple observations in parallel
-def create_dataloader(data, rand=True, cropped=False):
+# data is a subset of the data frame or an array of row positions in it
+# deterministic loaders are only used for evaluation and feature extraction, and load eval_batch_size observations at a time
+# persistent -- the loader is iterated more than once (finetuning epochs), so parallel loader workers are kept between passes
+def create_dataloader(data, rand=True, cropped=False, persistent=False):
+
+    if PARALLEL_LOADER:
+        return create_parallel_dataloader(data, rand=rand, cropped=cropped, persistent=persistent)
 
     if rand: # shuffle observations
-        dataset = CustomDataset(data, tr=True, cropped=cropped)
+        dataset = CustomDataset(data, tr=True, cropped=cropped, cache=image_cache, batch_augment=BATCH_AUGMENT, uint8=UINT8_BATCHES)
         loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0, drop_last=False)
     
     else: # load observations in the original order from data
-        dataset = CustomDataset(data, tr=False, cropped=cropped)
-        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, sampler = torch.utils.data.sampler.SequentialSampler(dataset), num_workers=0, drop_last=False)
+        dataset = CustomDataset(data, tr=False, cropped=cropped, cache=image_cache, uint8=UINT8_BATCHES)
+        dataset.read_ahead_block = eval_batch_size
+        loader = torch.utils.data.DataLoader(dataset, batch_size=eval_batch_size, shuffle=False, sampler = torch.utils.data.sampler.SequentialSampler(dataset), num_workers=0, drop_last=False)
+
+    return loader
+
+
+# same as create_dataloader, but with LOADER_WORKERS worker processes prefetching batches -- kept alive between passes if persistent
+# all randomness (shuffling, augmentation, worker seeds) comes from a generator seeded from the global torch seed (999)
+def create_parallel_dataloader(data, rand=True, cropped=False, persistent=False):
+
+    generator = torch.Generator()
+    generator.manual_seed(torch.empty((), dtype=torch.int64).random_().item())
+
+    workers = {}
+    if LOADER_WORKERS > 0:
+        workers = {'prefetch_factor': LOADER_PREFETCH, 'persistent_workers': persistent}
+
+    if rand: # shuffle observations
+        dataset = CustomDataset(data, tr=True, cropped=cropped, cache=image_cache, batch_augment=BATCH_AUGMENT, uint8=UINT8_BATCHES)
+        sampler = SeededRandomSampler(dataset, generator)
+    
+    else: # load observations in the original order from data
+        dataset = CustomDataset(data, tr=False, cropped=cropped, cache=image_cache, uint8=UINT8_BATCHES)
+        dataset.read_ahead_block = eval_batch_size
+        sampler = torch.utils.data.sampler.SequentialSampler(dataset)
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size if rand else eval_batch_size, sampler=sampler, num_workers=LOADER_WORKERS, 
+        worker_init_fn=seed_worker, generator=generator, drop_last=False, **workers)
+
+    return loader
+
+
+# deterministic loader of JointDataset -- eval_batch_size/2 observations, so eval_batch_size images, at a time
+def create_joint_dataloader(data):
+
+    dataset = JointDataset(data, cache=image_cache, uint8=UINT8_BATCHES)
+    for d in [dataset.full_dataset, dataset.cropped_dataset]:
+        d.read_ahead_block = max(eval_batch_size // 2, 1)
+        d.read_ahead_streams = 2
+    workers = {}
+    if PARALLEL_LOADER and LOADER_WORKERS > 0:
+        workers = {'num_workers': LOADER_WORKERS, 'prefetch_factor': LOADER_PREFETCH, 'worker_init_fn': seed_worker}
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size=max(eval_batch_size // 2, 1), shuffle=False, sampler=torch.utils.data.sampler.SequentialSampler(dataset), 
+        drop_last=False, **workers)
 
     return loader
 
@@ -1270,7 +2267,8 @@ def create_dataloader(data, rand=True, cropped=False):
 
 
 # finetune and save generic imagenet resnet neural net
-def finetune_and_save(loader_train, loader_test, n_epochs=20):
+# returns the state_dict of the finetuned net without its last layer, as used in the Ensemble -- saving to RESULTS is optional
+def finetune_and_save(loader_train, loader_test, n_epochs=20, save=True):
 
     # loading pretrained model and preparing it for finetuning
     model = models.resnet50(pretrained=True)
@@ -1310,8 +2308,69 @@ def finetune_and_save(loader_train, loader_test, n_epochs=20):
             json.dump(hist, fjson)
 
     # saving model
-    torch.save(model, RESULTS+"/finetuned_imgnet_model")
-    return
+    if save:
+        torch.save(model, RESULTS+"/finetuned_imgnet_model")
+    return torch.nn.Sequential(*list(model.children())[:-1]).state_dict()
+
+
+
+# compact student of the Ensemble -- imagenet resnet18 with its last layer mapping to the 4096 Ensemble features
+def get_student(dim=4096):
+    model = models.resnet18(pretrained=True)
+    model.fc = torch.nn.Linear(model.fc.in_features, dim)
+    if CUDA:
+        model.cuda()
+    return model
+
+
+# train a student to reproduce teacher features (a row of X_teacher per row of data) of the observations in rows
+# images come from a deterministic loader -- the transform the teacher features were extracted with -- over rows shuffled every epoch
+def distill_student(X_teacher, rows, n_epochs=10):
+
+    student = get_student(X_teacher.shape[1])
+    optimizer = optim.Adamax(params=student.parameters(), lr=0.001)
+
+    hist = {'train_loss': []}
+
+    for epoch in range(n_epochs):
+        student.train()
+        rows_epoch = np.random.permutation(rows)
+        loader = create_dataloader(rows_epoch, rand=False)
+        loss_hist = []
+        start = 0
+
+        for batch_i, (data, _, _) in enumerate(loader):
+            target = torch.from_numpy(X_teacher[rows_epoch[start:start+data.shape[0]]]).float()
+            start += data.shape[0]
+
+            if CUDA:
+                data, target = data.cuda(), target.cuda()
+            if data.dtype == torch.uint8:
+                data = normalize_batch(data)
+
+            loss = F.mse_loss(student(data), target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            loss_hist.append(loss.item())
+
+        hist['train_loss'].append(np.mean(loss_hist).item())
+        with open(RESULTS+'/distillation_record.json', 'w') as fjson:
+            json.dump(hist, fjson)
+
+    student.eval()
+    return student
+
+
+# student features of a deterministic loader, in loader order
+def student_features(student, loader):
+    X = []
+    start = 0
+    with torch.no_grad():
+        for data, _, _ in loader:
+            X.append(extract_batch(student, data, loader.dataset, start))
+            start += data.shape[0]
+    return np.concatenate(X)
 
 
 
@@ -1328,6 +2387,14 @@ def run_epoch(model, loss_f, optimizer, loader, update_model = False):
 
     for batch_i, var in enumerate(loader):
 
+        # uint8 batches come from datasets that leave random transformations and/or normalization to the whole batch
+        data, target, immetr = var
+        if data.dtype == torch.uint8:
+            if CUDA:
+                data = data.cuda()
+            data = augment_batch(data) if (update_model and loader.dataset.batch_augment) else normalize_batch(data)
+            var = (data, target, immetr)
+
         loss = loss_f(model, var)
 
         if update_model:
@@ -1375,48 +2442,192 @@ def loss_f(model, var):
 # extract data from a dataloader as a set of image features X and set of labels y, corresponding to those image features
 # can also blackout specified areas of the loaded images before extracting the image features -- this is used in our experiments
 # when data loader is deterministic, then it will load in the same data again and again
+# with the feature store enabled, features already computed for the same weights, images and blackout are read from it --
+# the VGGFace2 half (VGG_CACHE) and/or the whole Ensemble output (FEATURE_STORE)
+# features are computed without autograd and written straight into a preallocated array; labels and image metrics come from the dataset arrays
 def extract_data(loader, model, blackout=None):
 
-    X = []
-    y = []
-    z = []
+    # features are written in dataset order, so they only line up with the labels below for loaders that keep that order
+    if not isinstance(loader.sampler, torch.utils.data.sampler.SequentialSampler):
+        raise ValueError('extract_data needs a deterministic loader (create_dataloader(..., rand=False))')
 
-    for batch_i, var in enumerate(loader):
+    # labels and image metrics of the observations, in loader order
+    rows = loader.dataset.rows
+    y = label_matrix[rows].astype('int32')
+    z = metric_matrix[rows].astype('float32')
 
-        data, target, immetr = var
-        
-        if blackout is not None:
-            data[:, :, blackout[0]:blackout[1],  blackout[2]:blackout[3]] = 0.0
+    use_store = feature_store is not None
 
-        data, target, immetr = Variable(data), Variable(target), Variable(immetr)
-        if CUDA:
-            data, target, immetr = data.cuda(), target.cuda(), immetr.cuda()
+    # whole extraction served from the store -- no images are loaded at all
+    if use_store and FEATURE_STORE:
+        X = feature_store.lookup(model.weights_hash(), loader.dataset.paths, loader.dataset.cropped, blackout)
+        if X is not None:
+            return X.squeeze(), y, z
+
+    # deterministic loaders split across forked processes
+    if EXTRACT_WORKERS > 1 and not CUDA:
+        return extract_data_sharded(loader, model, blackout, use_store).squeeze(), y, z
+
+    X = None
+    start = 0
+
+    with torch.no_grad():
+        for batch_i, var in enumerate(loader):
+
+            data, _, _ = var
+            end = start + data.shape[0]
+
+            data_out = extract_batch(model, data, loader.dataset, start, blackout, use_store)
+            if X is None:
+                X = np.empty((len(loader.dataset), data_out.shape[1]), dtype=data_out.dtype)
+            X[start:end] = data_out
+            start = end
+
+    return X.squeeze(), y, z
+
+
+# features of one batch of dataset, starting at position start
+def extract_batch(model, data, dataset, start, blackout=None, use_store=False):
+    end = start + data.shape[0]
+
+    # uint8 batches are scaled and normalized here, before any blackout (which sets normalized values to 0)
+    if CUDA:
+        data = data.cuda()
+    if data.dtype == torch.uint8:
+        data = normalize_batch(data)
     
+    if blackout is not None:
+        data[:, :, blackout[0]:blackout[1],  blackout[2]:blackout[3]] = 0.0
+
+    if use_store:
+        data_out = model.forward_cached(data, feature_store, dataset.paths[start:end], dataset.cropped, blackout, full=FEATURE_STORE, branch=VGG_CACHE)
+    else:
         data_out = model(data)
 
-        X.append(data_out.detach().cpu().numpy())
-        y.append(target.detach().cpu().numpy())
-        z.append(immetr.detach().cpu().numpy())
+    return data_out.cpu().numpy().reshape(data_out.shape[0], -1)
+
+
+# sharded extraction -- (model, dataset, batch size, blackout, use_store), inherited by the forked worker processes
+_shard_job = None
+
+# features of batches first to last-1 of _shard_job -- the same batches, so the same numbers, as the serial loop of extract_data
+def extract_shard(batches):
+    model, dataset, bs, blackout, use_store = _shard_job
+
+    first, last = batches
+    start = first*bs
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, range(start, min(last*bs, len(dataset)))), batch_size=bs, shuffle=False, num_workers=0)
+
+    X = []
+    with torch.no_grad():
+        for data, _, _ in loader:
+            X.append(extract_batch(model, data, dataset, start, blackout, use_store))
+            start += data.shape[0]
+    return np.concatenate(X)
+
+
+# extract_data features of a deterministic loader, with its batches split into EXTRACT_WORKERS contiguous shards
+# each computed by a forked process holding a copy-on-write replica of the model, and merged back in loader order
+# the first batch runs in this process, so FeatureStore tables exist before forking (workers only write to existing tables)
+# every batch runs on one torch thread: an OpenMP pool this process used before (e.g. to finetune) is not usable after a fork,
+# and the first batch then gives the same numbers as the others
+def extract_data_sharded(loader, model, blackout=None, use_store=False):
+    global _shard_job
+
+    bs = loader.batch_size
+    n_batches = -(-len(loader.dataset) // bs)
+    _shard_job = (model, loader.dataset, bs, blackout, use_store)
+
+    n_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+
+    X = [extract_shard((0, 1))]
+    shards = [(int(b[0]), int(b[-1])+1) for b in np.array_split(np.arange(1, n_batches), EXTRACT_WORKERS) if b.shape[0] > 0]
+    if len(shards) > 0:
+        with multiprocessing.get_context('fork').Pool(len(shards)) as pool:
+            X += pool.map(extract_shard, shards)
+
+    torch.set_num_threads(n_threads)
+    _shard_job = None
+    return np.concatenate(X)
+
+
+# features of the full and of the cropped images of a joint loader, with their labels and image metrics, in one pass:
+# both images of an observation go through the model in the same batch -- or, with a feature store, as two batches served by the store
+def extract_data_joint(loader, model):
+
+    full_dataset, cropped_dataset = loader.dataset.full_dataset, loader.dataset.cropped_dataset
+    rows = loader.dataset.rows
+    y = label_matrix[rows].astype('int32')
+    z = metric_matrix[rows].astype('float32')
+
+    use_store = feature_store is not None
+
+    # whole extraction served from the store -- no images are loaded at all
+    if use_store and FEATURE_STORE:
+        X = feature_store.lookup(model.weights_hash(), full_dataset.paths, False)
+        X_cropped = feature_store.lookup(model.weights_hash(), cropped_dataset.paths, True)
+        if X is not None and X_cropped is not None:
+            return X.squeeze(), X_cropped.squeeze(), y, z
+
+    X = None
+    start = 0
+
+    with torch.no_grad():
+        for batch_i, var in enumerate(loader):
+
+            data, data_cropped, _, _ = var
+            end = start + data.shape[0]
 
+            if use_store:
+                data_out = extract_batch(model, data, full_dataset, start, use_store=True)
+                data_out_cropped = extract_batch(model, data_cropped, cropped_dataset, start, use_store=True)
+            else:
+                data_out = extract_batch(model, torch.cat((data, data_cropped)), full_dataset, start)
+                data_out, data_out_cropped = data_out[:data.shape[0]], data_out[data.shape[0]:]
 
-    X = np.vstack(X).squeeze()
-    y = np.vstack(y)
-    z = np.vstack(z)
+            if X is None:
+                X = np.empty((len(loader.dataset), data_out.shape[1]), dtype=data_out.dtype)
+                X_cropped = np.empty((len(loader.dataset), data_out.shape[1]), dtype=data_out.dtype)
+            X[start:end] = data_out
+            X_cropped[start:end] = data_out_cropped
+            start = end
 
-    return X, y, z
+    return X.squeeze(), X_cropped.squeeze(), y, z
+
+
+
+'''
+StackedLinearHead stacks fitted linear models (one BayesianRidge per variable) into a coefficient matrix W and an intercept vector b,
+so that the scores of all variables are one GEMM: X @ W + b, the same as calling predict of every model.
+Given the TruncatedSVD the models were fitted on, svd.transform is folded into W -- the head then scores image features directly.
+'''
+
+class StackedLinearHead(object):
+
+    def __init__(self, models, svd=None):
+        self.W = np.stack([mod.coef_ for mod in models], 1)
+        self.b = np.array([mod.intercept_ for mod in models])
+        if svd is not None:
+            self.W = fdot(svd.components_.T, self.W)
+
+    def predict(self, X):
+        return fdot(np.asarray(X, dtype=self.W.dtype), self.W) + self.b
 
 
 
 # function to evaluate a set of trained classifier using AUC metric
 # 'models' contains classifiers in order of binary variables to be predicted -- which are contaiend in Y
 # X is a matrix of covariates
+# models can also be given already stacked, as a StackedLinearHead
 def analytics_lin(models, X, Y):
+    head = models if isinstance(models, StackedLinearHead) else StackedLinearHead(models)
+    Y_prob = head.predict(X)
     auc = {}
     for i in range(Y.shape[1]):
         y_true = Y[:,i]
-        mod = models[i]
         # auc
-        y_prob = mod.predict(X)
+        y_prob = Y_prob[:,i]
         if np.unique(y_true).shape[0] > 1: 
             auc[q_list[i]] = metrics.roc_auc_score(y_true, y_prob)
         else:
@@ -1433,22 +2644,375 @@ def sliding_window(image_shape, stepSize, windowSize):
             yield (yc, yc + windowSize[1], xc, xc + windowSize[0])
 
 
+# features of every image of dat with each of the windows blacked out -- a (windows x images x features) array -- and the labels of the images
+# every image is decoded once: its blacked-out variants are built in memory and go through the model about OCCLUSION_BATCH images at a time
+# windows already in the feature store (FEATURE_STORE) are read from it, the others are written to it
+# with VGG_CACHE, the modelB output of an Ensemble is stored per window as well -- windows whose modelB output is stored only run modelA
+def occlusion_features(model, dat, windows):
+
+    loader = create_dataloader(dat, rand=False)
+    dataset = loader.dataset
+    Y = label_matrix[dataset.rows].astype('int32')
+
+    # activations are reused across windows by Ensembles whose branches are plain conv nets (not quantized graphs)
+    incremental = INCREMENTAL_OCCLUSION and isinstance(model, Ensemble) and model.precision != 'int8'
+
+    X = None
+    todo = list(range(len(windows)))
+    use_store = feature_store is not None and FEATURE_STORE
+    if use_store:
+        for w, window in enumerate(windows):
+            stored = feature_store.lookup(model.weights_hash(), dataset.paths, dataset.cropped, window)
+            if stored is not None:
+                if X is None:
+                    X = np.empty((len(windows),) + stored.shape, dtype=stored.dtype)
+                X[w] = stored
+                todo.remove(w)
+        if len(todo) == 0:
+            return X, Y
+
+    # modelB outputs of the remaining windows, where stored
+    use_branch = feature_store is not None and VGG_CACHE and isinstance(model, Ensemble)
+    X_b = {}
+    if use_branch:
+        for w in todo:
+            stored = feature_store.lookup(model.weights_hash('modelB'), dataset.paths, dataset.cropped, windows[w])
+            if stored is not None:
+                X_b[w] = stored
+    todo_a = [w for w in todo if w in X_b]
+    todo_ab = [w for w in todo if w not in X_b]
+
+    start = 0
+
+    with torch.no_grad():
+        for batch_i, (data, _, _) in enumerate(loader):
+
+            end = start + data.shape[0]
+
+            # blackout sets normalized values to 0
+            if CUDA:
+                data = data.cuda()
+            data = normalize_batch(data) if data.dtype == torch.uint8 else data
+
+            if incremental and batch_i == 0:
+                check_incremental_occlusion(model, data[:1], [windows[w] for w in todo])
+
+            outs = []
+            if len(todo_ab) > 0 and use_branch:
+                out_a, out_b = occluded_batch(model, data, [windows[w] for w in todo_ab], incremental, ('modelA', 'modelB'))
+                for i, w in enumerate(todo_ab):
+                    feature_store.store(model.weights_hash('modelB'), dataset.paths[start:end], dataset.cropped, windows[w], out_b[i])
+                outs.append((todo_ab, np.concatenate((out_a, out_b), axis=2)))
+            elif len(todo_ab) > 0:
+                out, = occluded_batch(model, data, [windows[w] for w in todo_ab], incremental)
+                outs.append((todo_ab, out))
+            if len(todo_a) > 0:
+                out_a, = occluded_batch(model, data, [windows[w] for w in todo_a], incremental, ('modelA',))
+                out_b = np.stack([X_b[w][start:end] for w in todo_a]).astype(out_a.dtype)
+                outs.append((todo_a, np.concatenate((out_a, out_b), axis=2)))
+
+            for todo_out, out in outs:
+                if X is None:
+                    X = np.empty((len(windows), len(dataset), out.shape[2]), dtype=out.dtype)
+                for i, w in enumerate(todo_out):
+                    X[w, start:end] = out[i]
+                    if use_store:
+                        feature_store.store(model.weights_hash(), dataset.paths[start:end], dataset.cropped, windows[w], out[i])
+
+            start = end
+
+    return X, Y
+
+
+# features of a batch with each of the windows blacked out, as a list with one (windows x images x features) array --
+# of the model, or, with parts, of each of those branches of an Ensemble ('modelA' and/or 'modelB')
+# incremental -- by Ensemble.forward_occluded on parts of the batch, otherwise by the model on groups of windows, with variants in window-major order
+def occluded_batch(model, data, windows, incremental=False, parts=None):
+
+    if incremental:
+        outs = []
+        for x in data.split(max(OCCLUSION_BATCH // len(windows), 1)):
+            outs.append(model.forward_occluded(x, windows, parts) if parts is not None else [model.forward_occluded(x, windows)])
+        outs = [torch.cat(o, dim=1) for o in zip(*outs)]
+
+    else:
+        outs = []
+        group = max(OCCLUSION_BATCH // data.shape[0], 1)
+        for g in range(0, len(windows), group):
+            group_windows = windows[g:g+group]
+            variants = data.repeat(len(group_windows), 1, 1, 1).view(len(group_windows), *data.shape)
+            for i, (y0, y1, x0, x1) in enumerate(group_windows):
+                variants[i, :, :, y0:y1, x0:x1] = 0.0
+            variants = variants.view(-1, *data.shape[1:])
+            if parts is None:
+                group_outs = [model(variants)]
+            elif tuple(parts) == ('modelA', 'modelB'):
+                group_outs = list(model.branches(variants))
+            else:
+                group_outs = [model.branch(part, variants, torch.is_grad_enabled()) for part in parts]
+            outs.append([o.view(len(group_windows), data.shape[0], -1) for o in group_outs])
+        outs = [torch.cat(o) for o in zip(*outs)]
+
+    return [o.cpu().numpy().reshape(len(windows), data.shape[0], -1) for o in outs]
+
+
+# incremental occlusion of images x against full forward passes -- raises if they differ by more than float tolerance (relative to the largest feature)
+def check_incremental_occlusion(model, x, windows, tol=1e-3):
+    X_incremental, = occluded_batch(model, x, windows, incremental=True)
+    X_full, = occluded_batch(model, x, windows, incremental=False)
+    error = np.abs(X_incremental - X_full).max() / max(np.abs(X_full).max(), 1e-12)
+    if error > tol:
+        raise ValueError('incremental occlusion differs from full forward passes by {:.2e}'.format(error))
+
+
 # calculating decrease in AUC when blocking a particular area of an image -- over 8x8 grid placed over the image
+# or, with ADAPTIVE_OCCLUSION, over a quadtree: cells of a coarse grid are split in four (down to ADAPTIVE_MIN_SIZE pixels)
+# while blocking them decreases AUC of any significant variable (see significant_variables) by more than ADAPTIVE_THRESHOLD --
+# at most ADAPTIVE_BUDGET cells per level, those with the largest decrease; all evaluated cells are returned, see patch_importance_grid
 def img_area_importance(model, models, svd, dat, auc_true):
 
+    if ATTRIBUTION is not None:
+        return gradient_area_importance(model, models, svd, dat, auc_true)
+
+    if not ADAPTIVE_OCCLUSION:
+        windows = list(sliding_window(image_shape=(224,224), stepSize = 28, windowSize=(28,28)))
+        return windows_importance(model, models, svd, dat, auc_true, windows)
+
     patch_importance = {}
+    significant = significant_variables(auc_true, label_matrix[dat].astype('int32'))
+
+    windows = list(sliding_window(image_shape=(224,224), stepSize = ADAPTIVE_START, windowSize=(ADAPTIVE_START, ADAPTIVE_START)))
+    while len(windows) > 0:
+        # print('adaptive occlusion -- {} windows of {} pixels, {} significant variables'.format(len(windows), windows[0][1] - windows[0][0], len(significant)))
+        level = windows_importance(model, models, svd, dat, auc_true, windows)
+        patch_importance.update(level)
+
+        drops = {window: np.nanmax([level[window][q] for q in significant]) if len(significant) > 0 else 0.0 for window in windows}
+        split = [window for window in windows if window[1] - window[0] >= 2*ADAPTIVE_MIN_SIZE and drops[window] > ADAPTIVE_THRESHOLD]
+        split = sorted(split, key=lambda window: -drops[window])[:ADAPTIVE_BUDGET]
+        windows = []
+        for (y0, y1, x0, x1) in split:
+            ym, xm = (y0 + y1) // 2, (x0 + x1) // 2
+            windows += [(y0, ym, x0, xm), (y0, ym, xm, x1), (ym, y1, x0, xm), (ym, y1, xm, x1)]
+
+    return patch_importance
+
+
+# scores of all variables for the images of dat, and their attribution to each of the windows -- (images x variables), (images x windows x variables) --
+# by gradients through Ensemble -> svd -> linear heads (BayesianRidge), all linear after the Ensemble: scores = features @ W + b
+# ATTRIBUTION 'saliency' is gradient x input, 'integrated_gradients' averages gradients over ATTRIBUTION_STEPS images on the path from
+# the blacked-out image (all normalized values 0) -- either way, summed over a window it approximates the change in scores when blocking it
+# gradients are taken for the ATTRIBUTION_RANK top left singular vectors of W and mapped to all variables (exact for rank >= number of variables)
+# fidelity per variable is returned as well: 'captured' -- the share of the norm of its head inside those singular vectors, ||U_r U_r' W_q|| / ||W_q||,
+# and 'completeness_error' -- mean |attributions summed over the image - (score(x) - score(0))| / mean |score(x) - score(0)|, both in the captured part
+# (integrated gradients sum to the difference for enough steps, saliency in general does not)
+# cost per image: steps forward and steps x rank backward passes (a backward pass costs about two forward ones), so steps x (1 + 2 x rank)
+# forward passes, against one per window for occlusion -- 17 for saliency and 68 for integrated gradients with the defaults, 64 windows on the 8x8 grid
+def gradient_attribution(model, models, svd, dat, windows):
+
+    if getattr(model, 'precision', 'fp32') == 'int8':
+        raise ValueError('gradient attribution needs float weights -- quantized (int8) ensembles have no gradients')
+
+    # windows of a regular grid in sliding_window order are summed by a reshape, other windows one by one
+    cell = windows[0][1] - windows[0][0]
+    grid = 224 // cell if 224 % cell == 0 and windows == list(sliding_window(image_shape=(224,224), stepSize=cell, windowSize=(cell,cell))) else None
+
+    head = StackedLinearHead(models, svd)
+    W, b = head.W, head.b
+    U, S, Vt = np.linalg.svd(W, full_matrices=False)
+    r = min(ATTRIBUTION_RANK, S.shape[0])
+    U_r = torch.from_numpy(U[:, :r]).float()
+    SVt = S[:r, None] * Vt[:r]
+    captured = np.linalg.norm(U[:, :r].T @ W, axis=0) / np.maximum(np.linalg.norm(W, axis=0), 1e-12)
+    if CUDA:
+        U_r = U_r.cuda()
 
-    for (y0, y1, x0, x1) in sliding_window(image_shape=(224,224), stepSize = 28, windowSize=(28,28)):
+    # outputs along the singular vectors for the blacked-out image, the start of the integration path
+    with torch.no_grad():
+        out_zero = model(torch.zeros(1, 3, 224, 224, device=U_r.device)).view(1, -1) @ U_r
 
-        loader = create_dataloader(dat,rand=False)
+    steps = ATTRIBUTION_STEPS if ATTRIBUTION == 'integrated_gradients' else 1
+    loader = create_dataloader(dat, rand=False)
+    Y = label_matrix[loader.dataset.rows].astype('int32')
+
+    scores = []
+    attributions = []
+    deltas = []
+    totals = []
+
+    for batch_i, (data, _, _) in enumerate(loader):
+
+        if CUDA:
+            data = data.cuda()
+        data = normalize_batch(data) if data.dtype == torch.uint8 else data
+
+        for x in data.split(ATTRIBUTION_BATCH):
+
+            with torch.no_grad():
+                features = model(x).view(x.shape[0], -1)
+                scores.append(features.cpu().numpy() @ W + b)
+                deltas.append((features @ U_r - out_zero).cpu().numpy())
+
+            # window sums (and image sums) of gradient x input, per image and singular vector
+            P = torch.zeros(x.shape[0], r, len(windows), device=x.device)
+            T = torch.zeros(x.shape[0], r, device=x.device)
+            for step in range(1, steps+1):
+                x_step = (x * step / steps).requires_grad_()
+                out = model(x_step).view(x.shape[0], -1) @ U_r
+                for k in range(r):
+                    grad, = torch.autograd.grad(out[:, k].sum(), x_step, retain_graph=k < r-1)
+                    grad = (grad * x).sum(1)
+                    T[:, k] += grad.sum((1, 2)) / steps
+                    if grid is not None:
+                        P[:, k] += grad.reshape(x.shape[0], grid, cell, grid, cell).sum((2, 4)).view(x.shape[0], -1) / steps
+                    else:
+                        for w, (y0, y1, x0, x1) in enumerate(windows):
+                            P[:, k, w] += grad[:, y0:y1, x0:x1].sum((1, 2)) / steps
+
+            attributions.append(np.einsum('nkw,kq->nwq', P.cpu().numpy(), SVt))
+            totals.append(T.cpu().numpy())
+
+    delta = np.concatenate(deltas) @ SVt
+    total = np.concatenate(totals) @ SVt
+    completeness_error = np.abs(total - delta).mean(0) / np.maximum(np.abs(delta).mean(0), 1e-12)
+    fidelity = pd.DataFrame({'var': q_list, 'captured': captured, 'completeness_error': completeness_error})
+
+    return np.concatenate(scores), np.concatenate(attributions), Y, fidelity
+
+
+# decrease in AUC over the 8x8 grid, as img_area_importance, with the scores of blocked images approximated by
+# the scores minus their gradient_attribution to the blocked window -- no forward pass per window
+# variables whose head is captured by less than ATTRIBUTION_MIN_CAPTURED of its norm get NaN; the fidelity of every fold goes to results_attribution_fidelity
+def gradient_area_importance(model, models, svd, dat, auc_true):
+
+    windows = list(sliding_window(image_shape=(224,224), stepSize = 28, windowSize=(28,28)))
+    scores, attributions, Y, fidelity = gradient_attribution(model, models, svd, dat, windows)
+
+    fidelity['fold'] = len(results_attribution_fidelity)
+    results_attribution_fidelity.append(fidelity)
+    captured = dict(zip(fidelity['var'], fidelity['captured']))
+
+    patch_importance = {}
 
-        # X_modified_raw contains image features extracted from images with a portion of the image blocked
-        X_modified_raw, Y, _ = extract_data(loader, model, (y0, y1, x0, x1))
+    for w, (y0, y1, x0, x1) in enumerate(windows):
+
+        scores_modified = scores - attributions[:, w]
+
+        patch_importance_q = {} # contains -(decrease in auc after blocking of an image)
+
+        for i, q in enumerate(q_list):
+            if np.unique(Y[:,i]).shape[0] > 1 and captured[q] >= ATTRIBUTION_MIN_CAPTURED:
+                patch_importance_q[q] = auc_true[q] - metrics.roc_auc_score(Y[:,i], scores_modified[:,i])
+            else:
+                patch_importance_q[q] = np.NaN
+
+        patch_importance[(y0, y1, x0, x1)] = patch_importance_q
+
+    return patch_importance
+
+
+# (224/cell x 224/cell x variables) array of an img_area_importance result -- cells painted from the largest to the smallest,
+# so that the finest evaluated cell covering a grid cell gives its value
+def patch_importance_grid(patch_importance, cell=28):
+    arr = np.zeros((224 // cell, 224 // cell, len(q_list)), dtype=np.float32)
+    for (y0, y1, x0, x1) in sorted(patch_importance, key=lambda window: -(window[1]-window[0])*(window[3]-window[2])):
+        arr[y0//cell:y1//cell, x0//cell:x1//cell] = [patch_importance[(y0, y1, x0, x1)][q] for q in q_list]
+    return arr
+
+
+
+'''
+PatchImportance accumulates img_area_importance results of all folds in a memory-mapped (folds x grid x grid x variables) float32 array,
+with their mean and variance over folds updated online (Welford) as folds are added.
+save writes the mean and variance to a compressed .npz with one member per variable, which PatchImportanceMaps reads lazily.
+'''
+
+class PatchImportance(object):
+
+    def __init__(self, path, n_folds, cell=28):
+        self.cell = cell
+        self.values = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_folds, 224 // cell, 224 // cell, len(q_list)))
+        self.n = 0
+        self.mean = np.zeros(self.values.shape[1:])
+        self.m2 = np.zeros(self.values.shape[1:])
+
+    def add(self, patch_importance):
+        arr = patch_importance_grid(patch_importance, self.cell)
+        self.values[self.n] = arr
+        self.n += 1
+
+        delta = arr - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (arr - self.mean)
+
+    def variance(self):
+        return self.m2 / max(self.n - 1, 1)
+
+    def save(self, path):
+        self.values.flush()
+        variance = self.variance()
+        arrays = {'cell': np.array(self.cell), 'n_folds': np.array(self.n)}
+        for i, q in enumerate(q_list):
+            arrays['mean_'+q] = self.mean[:, :, i].astype(np.float32)
+            arrays['variance_'+q] = variance[:, :, i].astype(np.float32)
+        np.savez_compressed(path, **arrays)
+
+
+# 224x224 maps of mean importance per variable from a PatchImportance .npz, each read when first indexed
+class PatchImportanceMaps(object):
+
+    def __init__(self, path):
+        self.npz = np.load(path)
+        self.cell = int(self.npz['cell'])
+
+    def __getitem__(self, q):
+        return np.kron(self.npz['mean_'+q], np.ones((self.cell, self.cell)))
+
+
+# variables of auc_true (test AUCs of a fold) significantly above 0.5 for labels Y (images x variables) --
+# one-sided at level alpha, with the standard error of the AUC by Hanley and McNeil (1982)
+def significant_variables(auc_true, Y, alpha=0.05):
+    z = scipy.stats.norm.ppf(1 - alpha)
+    significant = []
+    for i, q in enumerate(q_list):
+        n1 = int((Y[:, i] == 1).sum())
+        n0 = int((Y[:, i] == 0).sum())
+        a = auc_true[q]
+        if n1 == 0 or n0 == 0 or np.isnan(a):
+            continue
+        q1, q2 = a / (2 - a), 2 * a**2 / (1 + a)
+        se = np.sqrt((a*(1 - a) + (n1 - 1)*(q1 - a**2) + (n0 - 1)*(q2 - a**2)) / (n1 * n0))
+        if a - z*se > 0.5:
+            significant.append(q)
+    return significant
+
+
+# decrease in AUC when blocking each of the windows of the images in dat
+def windows_importance(model, models, svd, dat, auc_true, windows):
+
+    patch_importance = {}
+    head = StackedLinearHead(models)
+
+    # features of all blocked images at once
+    batched = BATCHED_OCCLUSION or INCREMENTAL_OCCLUSION
+    if batched:
+        X_occluded, Y = occlusion_features(model, dat, windows)
+
+    for w, (y0, y1, x0, x1) in enumerate(windows):
+
+        if batched:
+            X_modified_raw = X_occluded[w]
+
+        else:
+            loader = create_dataloader(dat,rand=False)
+
+            # X_modified_raw contains image features extracted from images with a portion of the image blocked
+            X_modified_raw, Y, _ = extract_data(loader, model, (y0, y1, x0, x1))
 
         # image features reduced to 500 via svd
         X_modified = svd.transform(X_modified_raw)
 
-        auc = analytics_lin(models, X_modified, Y)
+        auc = analytics_lin(head, X_modified, Y)
 
         patch_importance_q = {} # contains -(decrease in auc after blocking of an image)
         
@@ -1461,6 +3025,35 @@ def img_area_importance(model, models, svd, dat, auc_true):
 
 
 
+# layout of a core budget per phase of the run -- torch intra-op threads, BLAS threads (sklearn), DataLoader workers
+# and sharded extraction processes, so that no phase uses more than cores
+# extraction (also finetuning) runs networks: loader workers are carved out first, the rest goes to torch threads of this process,
+# or to extraction processes of one thread each (see extract_data_sharded); with concurrent_branches both branches run at once, so each gets half
+# svd and regression are BLAS-bound and single-process; plotting gets one core of each kind
+def plan_cores(cores, loader_workers=0, extract_workers=0, concurrent_branches=False):
+    loader_workers = min(loader_workers, max(cores // 8, 1)) if loader_workers > 0 else 0
+    rest = max(max(cores - loader_workers, 1) // (2 if concurrent_branches else 1), 1)
+    extract_workers = min(extract_workers, rest) if extract_workers > 1 else 0
+
+    return {
+        'extraction': {'torch_threads': rest, 'blas_threads': 1, 'loader_workers': loader_workers, 'extract_workers': extract_workers},
+        'svd': {'torch_threads': 1, 'blas_threads': cores, 'loader_workers': 0, 'extract_workers': 0},
+        'regression': {'torch_threads': 1, 'blas_threads': cores, 'loader_workers': 0, 'extract_workers': 0},
+        'plotting': {'torch_threads': 1, 'blas_threads': 1, 'loader_workers': 0, 'extract_workers': 0},
+    }
+
+
+# switch torch and BLAS threads to the budget of a phase of core_plan (no-op without a plan)
+# threadpoolctl (installed with scikit-learn) is only needed with a plan, that is with CORE_BUDGET set
+def set_core_phase(phase):
+    if core_plan is None:
+        return
+    from threadpoolctl import threadpool_limits
+    torch.set_num_threads(core_plan[phase]['torch_threads'])
+    threadpool_limits(limits=core_plan[phase]['blas_threads'])
+
+
+
 
 # START OF THE RUN
 
@@ -1473,13 +3066,124 @@ CUDA = torch.cuda.is_available()
 PATH = './data'
 RESULTS = './results'
 
+CACHE = './cache'
+DATA_ZIP = './data.zip'
+
 batch_size = 10
+eval_batch_size = 64 # deterministic loaders (evaluation, feature extraction) -- models are in eval mode, so features do not depend on it
+
+# decode every image once into a memory-mapped uint8 cache used by deterministic data loaders
+IMAGE_CACHE = False
+
+# seeded multi-process data loading -- augmentation order is reproducible for any number of workers
+PARALLEL_LOADER = False
+LOADER_WORKERS = 4
+LOADER_PREFETCH = 2 # batches prefetched per worker
+
+# read data.csv and images straight from DATA_ZIP instead of the unpacked PATH folder
+ZIP_DATA = False
+ZIP_THREADS = 4 # threads reading ahead from the archive
+
+# datasets yield uint8 images (4x less inter-process traffic); scaling and normalization run once per batch
+UINT8_BATCHES = False
+
+# keep data.csv, the label matrix and the image metric matrix as memory-mapped binary files in CACHE after the first run
+DATA_CACHE = False
+
+# compute the (never finetuned) VGGFace2 half of the Ensemble once per image and transform, persisted in CACHE
+VGG_CACHE = False
+
+# persist every Ensemble output keyed by (weights hash, image path, cropped flag, blackout) -- reruns skip unchanged forward passes
+FEATURE_STORE = False
+
+# decode JPEGs at reduced resolution (PIL draft mode) before the exact resize to 224 -- a pixel-difference check is saved to RESULTS
+JPEG_DRAFT = False
+
+# training loaders yield resized uint8 images; flips, crops, rotations and color jitter run on whole batches in run_epoch
+BATCH_AUGMENT = False
+
+# keep the Ensemble in memory across folds and swap in each finetuned ImageNet net, instead of a save/load round-trip through RESULTS
+MODEL_REGISTRY = False
+
+# write each fold's finetuned ImageNet net to RESULTS -- always done without MODEL_REGISTRY, and read by the final model below
+SAVE_FINETUNED = True
+
+# image area importance from all 64 blocked variants of each test image, decoded once and run in batches of about OCCLUSION_BATCH images
+BATCHED_OCCLUSION = False
+OCCLUSION_BATCH = 256
+
+# image area importance from gradients instead of blocked images: None (occlusion), 'saliency' or 'integrated_gradients' (see gradient_attribution)
+# costs about ATTRIBUTION_STEPS x (1 + 2 x ATTRIBUTION_RANK) forward passes per image ('saliency': one step), against 64 for occlusion on the 8x8 grid
+# approximate with the defaults: heads are projected on ATTRIBUTION_RANK singular vectors (variables captured by less than ATTRIBUTION_MIN_CAPTURED
+# are left NaN) and integrated over ATTRIBUTION_STEPS steps -- the captured share and completeness error per fold are saved to attribution_fidelity.csv
+ATTRIBUTION = None
+ATTRIBUTION_RANK = 8
+ATTRIBUTION_STEPS = 4
+ATTRIBUTION_BATCH = 16
+ATTRIBUTION_MIN_CAPTURED = 0.9
+
+# image area importance over an adaptive quadtree instead of the 8x8 grid -- from ADAPTIVE_START-pixel cells, split while the AUC of a
+# significant variable drops more than ADAPTIVE_THRESHOLD, at most ADAPTIVE_BUDGET cells per level (4x as many windows on the next one)
+ADAPTIVE_OCCLUSION = False
+ADAPTIVE_START = 56
+ADAPTIVE_MIN_SIZE = 7
+ADAPTIVE_THRESHOLD = 0.01
+ADAPTIVE_BUDGET = 8
+
+# batched occlusion (implied) recomputing, per window, only the activations each layer's receptive field reaches from the blocked area (float tolerance of full passes)
+INCREMENTAL_OCCLUSION = False
+
+# extract features of the full and cropped images of a fold in one pass of a JointDataset, both images of an observation in the same batch
+JOINT_EXTRACTION = False
+
+# run the two branches of the Ensemble at the same time, on two threads -- same output, lower latency per batch
+CONCURRENT_BRANCHES = False
+
+# split feature extraction of deterministic loaders across this many forked processes (CPU only) -- bit-identical to a single process
+EXTRACT_WORKERS = 0
+
+# only train a compact student on the final Ensemble features and compare its AUCs to the teacher (DISTILLATION) -- skips the cross-validation
+DISTILL = False
+
+# final finetuned Ensemble restored from a frozen TorchScript artifact in RESULTS (exported on the first run, rebuilt if the weights change)
+FROZEN_MODEL = False
+
+# CPU inference of the finetuned Ensemble in lower precision: None (fp32), 'int8' (static quantization) or 'bf16' (bfloat16 autocast)
+LOW_PRECISION = None
+
+# in every fold, compare the LOW_PRECISION model to its fp32 finetuned weights on PRECISION_REPORT_IDS of the fold's respondents
+# -- features and AUCs, saved to RESULTS
+PRECISION_REPORT = False
+PRECISION_REPORT_IDS = 500
+
+# cores to split across torch, BLAS, loader workers and extraction processes per phase (0 -- all cores); None keeps one torch thread
+CORE_BUDGET = None
 
 os.makedirs(RESULTS, exist_ok=True)
 
+# LOADER_WORKERS and EXTRACT_WORKERS become the planned numbers, as loaders and extraction read them when they are created / run
+core_plan = None
+if CORE_BUDGET is not None:
+    core_plan = plan_cores(CORE_BUDGET or os.cpu_count(), LOADER_WORKERS if PARALLEL_LOADER else 0, EXTRACT_WORKERS, CONCURRENT_BRANCHES)
+    LOADER_WORKERS = core_plan['extraction']['loader_workers'] if PARALLEL_LOADER else LOADER_WORKERS
+    EXTRACT_WORKERS = core_plan['extraction']['extract_workers']
+
+    with open(RESULTS+'/core_plan.json', 'w') as fjson:
+        json.dump(core_plan, fjson)
+    print(pd.DataFrame(core_plan).T.to_string())
+
 
 #finetune model just by running this script
-data = pd.read_csv(PATH+'/data.csv')
+zip_source = ZipSource(DATA_ZIP, threads=ZIP_THREADS) if ZIP_DATA else None
+data = read_data(CACHE+'/data' if DATA_CACHE else None)
+
+if JPEG_DRAFT:
+    draft_check = draft_decode_difference(data)
+    draft_check.to_csv(RESULTS+'/jpeg_draft_check.csv', index=False)
+    print('JPEG draft decoding, abs. pixel difference -- mean: {:.3f}, max: {:.0f}'.format(draft_check['mean_abs_diff'].mean(), draft_check['max_abs_diff'].max()))
+
+# draft and full-resolution decoding give slightly different pixels, so they are cached separately
+image_cache = get_image_cache(data, CACHE+('/images_draft' if JPEG_DRAFT else '/images')) if IMAGE_CACHE else None
 
 # data summary stats
 
@@ -1516,6 +3220,15 @@ for i in q_list:
 # image metrics
 im_list = sorted(list(image_metrics.keys()))
 
+# labels as int8 and image metrics as float32, one row per observation in data -- shared by all datasets
+label_matrix, metric_matrix = get_data_matrices(data, CACHE+'/data' if DATA_CACHE else None)
+
+# image paths (full and cropped) per observation in data
+image_paths = read_image_paths(data, CACHE+'/data' if DATA_CACHE else None)
+
+# image features persisted per (weights, image, transform) -- VGGFace2 features and/or whole Ensemble outputs
+feature_store = FeatureStore(CACHE+'/features') if (VGG_CACHE or FEATURE_STORE) else None
+
 
 # https://stats.stackexchange.com/questions/328614/estimation-of-bayesian-ridge-regression
 # Bayesian ridge regresssion - linear probability model
@@ -1533,6 +3246,37 @@ def train_eval_regressions(Xtr, Ytr, Xts, Yts):
     return auc, lin_models
 
 
+# drift of low-precision CPU inference (model_lp) against the fp32 model it was made from, on a sample of n_ids respondents of a fold
+# (train and test respondents in proportion, rows in the order given by rank): per-image relative error and cosine similarity of the features,
+# and the change in test AUC when the ridge models fitted on fp32 features are scored on low-precision ones
+def precision_drift_report(model, model_lp, train_ids, test_ids, rank, n_ids=500, seed=0):
+    rs = np.random.RandomState(seed)
+    n_train = min(int(round(n_ids * len(train_ids) / (len(train_ids) + len(test_ids)))), len(train_ids))
+    n_test = min(n_ids - n_train, len(test_ids))
+    rows_train = respondent_index.gather(rs.choice(train_ids, size=n_train, replace=False), rank)
+    rows_test = respondent_index.gather(rs.choice(test_ids, size=n_test, replace=False), rank)
+
+    X_train_raw, Y_train, _ = extract_data(create_dataloader(rows_train, rand=False), model)
+    X_test_raw, Y_test, _ = extract_data(create_dataloader(rows_test, rand=False), model)
+    X_test_raw_lp, _, _ = extract_data(create_dataloader(rows_test, rand=False), model_lp)
+
+    rel_err = np.linalg.norm(X_test_raw_lp - X_test_raw, axis=1) / np.linalg.norm(X_test_raw, axis=1)
+    cosine = (X_test_raw_lp * X_test_raw).sum(1) / (np.linalg.norm(X_test_raw_lp, axis=1) * np.linalg.norm(X_test_raw, axis=1))
+
+    svd = TruncatedSVD(n_components=min(500, X_train_raw.shape[0]-1), random_state=0, n_iter=100).fit(X_train_raw)
+    auc, lin_models = train_eval_regressions(svd.transform(X_train_raw), Y_train, svd.transform(X_test_raw), Y_test)
+    auc_lp = analytics_lin(lin_models, svd.transform(X_test_raw_lp), Y_test)
+
+    precision = model_lp.precision
+    report = pd.DataFrame({'var': q_list, 'auc_fp32': [auc[q] for q in q_list], 'auc_'+precision: [auc_lp[q] for q in q_list]})
+    report['auc_diff'] = report['auc_'+precision] - report['auc_fp32']
+
+    summary = {'precision': precision, 'n_train': int(rows_train.shape[0]), 'n_test': int(rows_test.shape[0]),
+        'feature_rel_err_mean': float(rel_err.mean()), 'feature_rel_err_max': float(rel_err.max()), 'feature_cosine_min': float(cosine.min()),
+        'auc_abs_diff_mean': float(report['auc_diff'].abs().mean()), 'auc_abs_diff_max': float(report['auc_diff'].abs().max())}
+    return report, summary
+
+
 
 # CODING INDIVIDUALS INTO GROUPS BY DEMOGRAPHICS
 
@@ -1575,7 +3319,6 @@ np.random.seed(999)
 torch.manual_seed(999)
 
 results_auc = []
-results_patch_importance = []
 results_auc_cropped = []
 results_auc_demographics = []
 results_auc_shallowfacemetrics = []
@@ -1586,19 +3329,83 @@ results_auc_all_plus_img_cropped = []
 # individual IDs
 IDs = data['randomID'].unique()
 
+# rows of every individual -- folds are gathered from it as arrays of row positions
+respondent_index = RespondentIndex(data['randomID'].values)
+
+
+# DISTILLATION
+# student trained on teacher (final Ensemble) features X_raw of 80% of respondents; ridge heads on svd features are fitted on
+# the same 80% with teacher and with student features, and evaluated on the other 20% -- AUC loss of the student per variable
+# runs on its own: the rest of the script (cross-validation and analyses) is skipped
+
+if DISTILL:
+
+    np.random.seed(999)
+    torch.manual_seed(999)
+
+    model = get_final_model()
+    set_core_phase('extraction')
+    X_raw, Y, _ = extract_data(create_dataloader(data, rand=False), model)
+
+    distill_IDs = data['randomID'].unique()
+    np.random.shuffle(distill_IDs)
+    n_train = int(0.8*distill_IDs.shape[0])
+    rows_train = respondent_index.gather(distill_IDs[:n_train])
+    rows_test = respondent_index.gather(distill_IDs[n_train:])
+
+    student = distill_student(X_raw, rows_train)
+    torch.save(student.state_dict(), RESULTS+'/student_model')
+
+    S_train_raw = student_features(student, create_dataloader(rows_train, rand=False))
+    S_test_raw = student_features(student, create_dataloader(rows_test, rand=False))
+
+    set_core_phase('svd')
+    svd = TruncatedSVD(n_components=500, random_state=0, n_iter=100).fit(X_raw[rows_train])
+    svd_student = TruncatedSVD(n_components=500, random_state=0, n_iter=100).fit(S_train_raw)
+
+    set_core_phase('regression')
+    auc_teacher, _ = train_eval_regressions(svd.transform(X_raw[rows_train]), Y[rows_train], svd.transform(X_raw[rows_test]), Y[rows_test])
+    auc_student, _ = train_eval_regressions(svd_student.transform(S_train_raw), Y[rows_train], svd_student.transform(S_test_raw), Y[rows_test])
+
+    distillation_auc = pd.DataFrame({'var': q_list, 'auc_teacher': [auc_teacher[q] for q in q_list], 'auc_student': [auc_student[q] for q in q_list]})
+    distillation_auc['auc_loss'] = distillation_auc['auc_teacher'] - distillation_auc['auc_student']
+    distillation_auc.to_csv(RESULTS+'/distillation_auc.csv', index=False)
+
+    print('student: {:.1f}M parameters -- AUC loss vs. teacher mean: {:.4f}, max: {:.4f}'.format(
+        sum(p.numel() for p in student.parameters())/1e6, distillation_auc['auc_loss'].mean(), distillation_auc['auc_loss'].max()))
+
+    raise SystemExit
+
 # random shuffle split generator
 # This is referred to as repeated training-test split, or leave-group-out cross-validation, or Monte Carlo cross-validation. 
 # See Applied Predictive Modeling by Kuhn and Johnson, Springer, 2013.
 # rs = ShuffleSplit(n_splits=5, test_size=0.2, random_state=999)
 
+# resident models, shared by all folds
+model_registry = ModelRegistry()
+
 n_reps = 20 # number of repeats for 5-fold cross-valaidtion
 gkf = KFold(n_splits=5)
 
+# PRECISION_REPORT -- per fold, AUC differences by variable and a summary of the feature drift
+results_precision_drift = []
+results_precision_drift_auc = []
+
+# ATTRIBUTION -- per fold, the fidelity of gradient_attribution by variable
+results_attribution_fidelity = []
+
+# image area importance of every fold, on the 8x8 grid (or the finest quadtree cells)
+results_patch_importance = PatchImportance(RESULTS+'/patch_importance_folds.npy', n_reps*gkf.get_n_splits(), ADAPTIVE_MIN_SIZE if ADAPTIVE_OCCLUSION else 28)
+
 for rep in tqdm(range(n_reps)):
 
     # shuffling every repetition to get new folds via cv procedure
     np.random.shuffle(IDs)
-    data_shuffled = data.sample(frac=1.0) # shufling observations too
+
+    # shufling observations too -- the same draw as data.sample(frac=1.0), kept as the rank of every row in the shuffled order
+    order = np.random.choice(data.shape[0], size=data.shape[0], replace=False)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
 
     #train_index, test_index = next(enumerate(rs.split(IDs)))[1]
     for train_index, test_index in tqdm(gkf.split(IDs)):
@@ -1607,39 +3414,60 @@ for rep in tqdm(range(n_reps)):
         trainID = IDs[train_index]
         testID = IDs[test_index]
 
-        # extracting split data
-        data_train = data_shuffled[data_shuffled['randomID'].isin(trainID)]
-        data_test = data_shuffled[data_shuffled['randomID'].isin(testID)]
+        # extracting split data -- row positions in shuffled order
+        rows_train = respondent_index.gather(trainID, rank)
+        rows_test = respondent_index.gather(testID, rank)
 
         # creating data loaders
-        loader_train = create_dataloader(data_train,rand=False)
-        loader_train_rand = create_dataloader(data_train,rand=True) # to finetune neural net
-        loader_test = create_dataloader(data_test,rand=False)
+        loader_train = create_dataloader(rows_train,rand=False)
+        loader_train_rand = create_dataloader(rows_train,rand=True,persistent=True) # to finetune neural net
+        loader_test = create_dataloader(rows_test,rand=False,persistent=True)
 
         # finetuning imgnet
-        finetune_and_save(loader_train_rand, loader_test)
+        set_core_phase('extraction')
+        finetuned_state = finetune_and_save(loader_train_rand, loader_test, save=SAVE_FINETUNED or not MODEL_REGISTRY)
 
         # loading a neural net ensemble
-        model = get_pretrained(finetuned=True)
-
-        # extracting image features, labels, and ratios calculated from images (used as control)
-        X_train_raw, Y_train, Z_train = extract_data(loader_train, model)
-        X_test_raw, Y_test, Z_test = extract_data(loader_test, model)
+        if MODEL_REGISTRY:
+            model = model_registry.get(finetuned_state)
+        else:
+            model = get_pretrained(finetuned=True)
+        if LOW_PRECISION is not None:
+            model_lp = low_precision_ensemble(model, LOW_PRECISION, loader_train)
+            # drift of the model actually used below against its fp32 weights -- under a forked torch RNG, so the folds do not change
+            if PRECISION_REPORT:
+                with torch.random.fork_rng(devices=[]):
+                    drift_report, drift_summary = precision_drift_report(model, model_lp, trainID, testID, rank, PRECISION_REPORT_IDS)
+                results_precision_drift.append(drift_summary)
+                results_precision_drift_auc.append(dict(zip(drift_report['var'], drift_report['auc_diff'])))
+            model = model_lp
+
+        # extracting image features (with JOINT_EXTRACTION, full and cropped in one pass), labels, and ratios calculated from images (used as control)
+        if JOINT_EXTRACTION:
+            X_train_raw, X_train_raw_cropped, Y_train, Z_train = extract_data_joint(create_joint_dataloader(rows_train), model)
+            X_test_raw, X_test_raw_cropped, Y_test, Z_test = extract_data_joint(create_joint_dataloader(rows_test), model)
+        else:
+            X_train_raw, Y_train, Z_train = extract_data(loader_train, model)
+            X_test_raw, Y_test, Z_test = extract_data(loader_test, model)
 
         # reducing number of features
+        set_core_phase('svd')
         svd = TruncatedSVD(n_components=500, random_state=0, n_iter=100).fit(X_train_raw)
         X_train = svd.transform(X_train_raw)
         X_test = svd.transform(X_test_raw)
 
-        # creating data loaders - CROPPED
-        loader_train_cropped = create_dataloader(data_train,rand=False,cropped=True)
-        loader_test_cropped = create_dataloader(data_test,rand=False,cropped=True)
+        if not JOINT_EXTRACTION:
+            # creating data loaders - CROPPED
+            loader_train_cropped = create_dataloader(rows_train,rand=False,cropped=True)
+            loader_test_cropped = create_dataloader(rows_test,rand=False,cropped=True)
 
-        # extracting image features and labels
-        X_train_raw_cropped, _, _ = extract_data(loader_train_cropped, model)
-        X_test_raw_cropped, _, _ = extract_data(loader_test_cropped, model)
+            # extracting image features and labels
+            set_core_phase('extraction')
+            X_train_raw_cropped, _, _ = extract_data(loader_train_cropped, model)
+            X_test_raw_cropped, _, _ = extract_data(loader_test_cropped, model)
 
         # reducing number of features
+        set_core_phase('svd')
         svd_cropped = TruncatedSVD(n_components=500, random_state=0, n_iter=100).fit(X_train_raw_cropped)
         X_train_cropped = svd_cropped.transform(X_train_raw_cropped)
         X_test_cropped = svd_cropped.transform(X_test_raw_cropped)
@@ -1661,14 +3489,17 @@ for rep in tqdm(range(n_reps)):
         # TRAINING
 
         # deep image features
+        set_core_phase('regression')
         auc, lin_models = train_eval_regressions(X_train, Y_train, X_test, Y_test)
         results_auc.append(auc)
 
         # heat maps - image area importance 
-        patch_importance = img_area_importance(model, lin_models, svd, data_test, auc)
-        results_patch_importance.append(patch_importance)
+        set_core_phase('extraction')
+        patch_importance = img_area_importance(model, lin_models, svd, rows_test, auc)
+        results_patch_importance.add(patch_importance)
 
         # deep image features CROPPED
+        set_core_phase('regression')
         auc, lin_models = train_eval_regressions(X_train_cropped, Y_train, X_test_cropped, Y_test)
         results_auc_cropped.append(auc)
 
@@ -1707,22 +3538,15 @@ pd.DataFrame(results_auc_shallowfacemetrics).to_csv(RESULTS+'/crossvalidation_au
 pd.DataFrame(results_auc_demographics_shallowfacemetrics).to_csv(RESULTS+'/crossvalidation_auc_demographics_shallowfacemetrics.csv', index=False)
 pd.DataFrame(results_auc_all_plus_img).to_csv(RESULTS+'/crossvalidation_auc_all_plus_img.csv', index=False)
 pd.DataFrame(results_auc_all_plus_img_cropped).to_csv(RESULTS+'/crossvalidation_auc_all_plus_img_cropped.csv', index=False)
+if PRECISION_REPORT and LOW_PRECISION is not None:
+    pd.DataFrame(results_precision_drift).to_csv(RESULTS+'/precision_drift_'+LOW_PRECISION+'.csv', index=False)
+    pd.DataFrame(results_precision_drift_auc).to_csv(RESULTS+'/precision_drift_'+LOW_PRECISION+'_auc.csv', index=False)
 
 
-# saving patch_importance
-patch_importance = {}
-for q in q_list:
-
-    arr = np.zeros((224,224))
-    
-    for (y0, y1, x0, x1) in sliding_window(image_shape=(224,224), stepSize = 28, windowSize=(28,28)):
-        arr[y0:y1, x0:x1] = np.mean([i[(y0, y1, x0, x1)][q] for i in results_patch_importance])
-
-    patch_importance[q] = arr.tolist()
-
-
-with open(RESULTS+'/patch_importance.json', 'w') as fjson:
-    json.dump(patch_importance, fjson)
+# saving patch_importance -- mean and variance over folds per variable (folds themselves are in patch_importance_folds.npy)
+results_patch_importance.save(RESULTS+'/patch_importance.npz')
+if ATTRIBUTION is not None:
+    pd.concat(results_attribution_fidelity).to_csv(RESULTS+'/attribution_fidelity.csv', index=False)
 
 
 
@@ -1730,6 +3554,7 @@ with open(RESULTS+'/patch_importance.json', 'w') as fjson:
 
 
 # VISUALIZATIONS
+set_core_phase('plotting')
 colors = ['#e6194B', '#3cb44b', '#ffe119', '#4363d8', '#f58231', 
     '#911eb4', '#42d4f4', '#f032e6', '#bfef45', '#fabebe', 
     '#469990', '#e6beff', '#9A6324', '#fffac8', '#800000', 
@@ -2449,6 +4274,8 @@ def extract_raw_images(loader):
     for batch_i, var in enumerate(loader):
 
         image_batch, _, _ = var
+        if image_batch.dtype == torch.uint8:
+            image_batch = normalize_batch(image_batch)
         images.append(image_batch.detach().cpu().numpy())
 
     images = np.vstack(images).squeeze()
@@ -2714,8 +4541,11 @@ background_image = Image.fromarray(np.uint8(background_image))
 os.makedirs(RESULTS+'/img_imp', exist_ok=True)
 os.makedirs(RESULTS+'/img_imp_background', exist_ok=True)
 
-# path importance loading
-patch_importance = json.loads(open(RESULTS+'/patch_importance.json').read())
+# path importance loading -- lazily per variable, or from patch_importance.json of earlier runs (as in ./results)
+if os.path.exists(RESULTS+'/patch_importance.npz'):
+    patch_importance = PatchImportanceMaps(RESULTS+'/patch_importance.npz')
+else:
+    patch_importance = json.loads(open(RESULTS+'/patch_importance.json').read())
 
 for q in q_list:
     arr = np.array(patch_importance[q])
@@ -2827,7 +4657,7 @@ np.random.seed(999)
 torch.manual_seed(999)
 loader_full_rand = create_dataloader(data,rand=True)
 #finetune_and_save(loader_full_rand, loader_full_rand) # training model on all of the data
-model = get_pretrained(finetuned=True)
+model = get_final_model()
 
 
 
@@ -2837,7 +4667,9 @@ np.random.seed(999)
 torch.manual_seed(999)
 
 loader_full = create_dataloader(data, rand=False)
+set_core_phase('extraction')
 X_raw, Y, Z = extract_data(loader_full, model)
+set_core_phase('svd')
 svd = TruncatedSVD(n_components=500, random_state=0, n_iter=100).fit(X_raw)
 X = svd.transform(X_raw)
 Y_df = pd.DataFrame(Y, columns=q_list)
@@ -2847,6 +4679,7 @@ Y_demographics = Y_demographics.values # [dem_code_var]
 
 browser_vars = ['Q6_1_TEXT_0', 'Q6_1_TEXT_1']
 Y_browser = Y_df[browser_vars].values
+set_core_phase('plotting')
 
 inp = np.concatenate([X, Y_demographics, Y_browser, Z],1)
 out = Y
@@ -2910,23 +4743,17 @@ corr[corr_sig].abs().min().min()
 
 # PREDICTIONS FROM IMAGES
 
+set_core_phase('regression')
 lin_models = []
 for i in range(len(q_list)): #tqdm
     clf = ridge_regression(X, Y[:,i])
     lin_models.append(clf)
 
 
-preds = []
-for i in range(Y.shape[1]):
-    mod = lin_models[i]
-    y_prob = mod.predict(X)
-    preds.append(y_prob)
+# all variables scored at once -- the ridge models as one stacked linear head
+preds = StackedLinearHead(lin_models).predict(X)
 
 
-preds = pd.DataFrame(preds).T
+preds = pd.DataFrame(preds)
 preds.columns = q_list
 preds.to_csv(RESULTS+'/pipeline_predictions.csv', index=False)
-
-
-
-